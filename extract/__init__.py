@@ -0,0 +1 @@
+from .extract import Extractor
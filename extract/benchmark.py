@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+##    Description    Benchmark suite for RDTextractor
+##
+##    Authors:       Elisabet Gregori (elisabet.gregori@upf.edu)
+##                   Ignacio Pasamontes (ignacio.pasamontes@upf.edu)
+##
+##    Copyright 2018 Elisabet Gregori & Ignacio Pasamontes
+##
+##    RDTextractor is free software: you can redistribute it
+##    and/or modify it under the terms of the GNU General Public
+##    License as published by the Free Software Foundation version 3.
+##
+##    RDTextractor is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with this code. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sys, time
+import pandas as pd
+
+import extract
+import synthetic
+
+# Queries run at every scale: a broad one over the whole anatomy and a
+# narrow one over a single organ, species, route and exposure window
+queries = {'broad': {'organ': ['body']},
+            'narrow': {'organ': ['organ 1'], 'species': ['rat'],
+                        'route': ['oral'], 'min_exposure': 1,
+                        'max_exposure': 28}}
+
+def timed(repeat, function, *args):
+    """
+    Run the function repeat times and return its last result and the
+    best wall time
+    """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time()-start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+def benchmark_scale(data_dir, version, repeat):
+    """
+    Time the stages of run() on the synthetic data set in data_dir and
+    return a row per stage and query
+    """
+    extractor = extract.Extractor(version, sqlite=os.path.join(data_dir, 'vitic.sqlite'),
+                                data_dir=data_dir)
+    rows = []
+    (study_df, find_df, indexes), seconds = timed(repeat, extract.load_version,
+                                                extractor.args, False)
+    rows.append(('load_version', '', seconds, len(find_df)))
+
+    for name, filters in sorted(queries.items()):
+        args = extract.spec_args(extractor.args, filters, 0)
+        relevant_find, seconds = timed(repeat, extract.relevant_findings,
+                                        args, study_df, find_df, None, indexes)
+        rows.append(('filter_study', name, seconds, len(relevant_find)))
+        filtered_find, seconds = timed(repeat, extract.expand, relevant_find, args)
+        rows.append(('expand', name, seconds, len(filtered_find)))
+        # The aggregation stage includes the filtering and the expansion
+        try:
+            (stats_df, group_df), seconds = timed(repeat, extract.aggregate,
+                                                args, study_df, find_df, None, indexes)
+        except extract.EmptyExtraction:
+            # Nothing to aggregate nor pivot at this scale
+            sys.stderr.write('Query %s selects no findings\n' %name)
+            rows.append(('aggregate', name, None, 0))
+            rows.append(('pivot', name, None, 0))
+            continue
+        rows.append(('aggregate', name, seconds, len(group_df)))
+        (quantitative_df, qualitative_df), seconds = timed(repeat,
+                                            extract.pivot_results, stats_df, group_df)
+        rows.append(('pivot', name, seconds, quantitative_df.shape[1]))
+    return rows
+
+def main ():
+    """
+    Parse arguments, generate the synthetic data sets and run the
+    benchmark on each of them.
+    """
+    parser = argparse.ArgumentParser(description='Time the stages of \
+            extract.py on synthetic Vitic data sets of increasing size, \
+            for versions 2016.1 (data files) and 2016.2 (SQLite stand-in \
+            of the Oracle database).')
+    parser.add_argument('--scales', help='Number of findings of each data \
+            set (default: 10000 100000 1000000).', type=int, nargs='+',
+            default=[10000, 100000, 1000000], required=False)
+    parser.add_argument('-v', '--version', help='Vitic database versions \
+            to benchmark (default: both).', choices=['2016.1', '2016.2'],
+            nargs='+', default=['2016.1', '2016.2'], required=False)
+    parser.add_argument('--repeat', help='Times each stage is run, keeping \
+            the best time (default: 3).', type=int, default=3, required=False)
+    parser.add_argument('--work_dir', help='Directory where the synthetic \
+            data sets are generated, and reused if already there \
+            (default: benchmark_data).', default='benchmark_data', required=False)
+    parser.add_argument('--label', help='Label of the run in the results, \
+            such as a commit or release (default: none).', default='',
+            required=False)
+    parser.add_argument('-o', '--output', help='TSV file the results are \
+            appended to (default: benchmark.tsv).', default='benchmark.tsv',
+            required=False)
+    args = parser.parse_args()
+
+    results = []
+    created = time.strftime('%Y-%m-%d %H:%M:%S')
+    for scale in args.scales:
+        data_dir = os.path.join(args.work_dir, str(scale))
+        if not os.path.isfile(os.path.join(data_dir, 'vitic.sqlite')):
+            sys.stderr.write('Generating data set with %d findings\n' %scale)
+            n_studies = max(scale//100, 10)
+            synthetic.generate(data_dir, n_studies=n_studies,
+                            n_substances=max(n_studies//5, 2), n_findings=scale)
+        for version in args.version:
+            sys.stderr.write('Benchmarking version %s with %d findings\n'
+                            %(version, scale))
+            for stage, query, seconds, rows in benchmark_scale(data_dir, version,
+                                                            args.repeat):
+                results.append((created, args.label, version, scale, stage,
+                                query, seconds, rows))
+
+    results_df = pd.DataFrame(results, columns=['created', 'label', 'version',
+                                'scale', 'stage', 'query', 'seconds', 'rows'])
+    sys.stdout.write(results_df.drop(['created', 'label'], axis=1).to_string(index=False)+'\n')
+    results_df.to_csv(args.output, sep='\t', index=False, mode='a',
+                    header=not os.path.isfile(args.output))
+
+if __name__ == '__main__':
+    main()
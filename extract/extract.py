@@ -20,393 +20,2336 @@
 ##    You should have received a copy of the GNU General Public License
 ##    along with this code. If not, see <http://www.gnu.org/licenses/>.
 
-import argparse, os, sys, time, math
+import argparse, cProfile, hashlib, json, multiprocessing, os, shutil, sqlite3, sys, \
+    tempfile, time, math
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import numpy as np
 import pandas as pd
 # Disable SettingWithCopyWarning warnings
 pd.set_option('chained_assignment', None)
-import cx_Oracle
+try:
+    # Peak memory is only available on Unix
+    import resource
+except ImportError:
+    resource = None
 
-# Load ontology dataframe
+def walk_graph(graph):
+    """
+    Compute, for every term in the graph (term -> list of adjacent terms),
+    the set of all the terms reachable from it
+    """
+    reach = {}
+    for term in graph:
+        related_set = set()
+        level = graph[term]
+        while level:
+            next_level = []
+            for related in level:
+                if related not in related_set and related != term:
+                    related_set.add(related)
+                    next_level.extend(graph.get(related, []))
+            level = next_level
+        reach[term] = related_set
+    return reach
+
+def build_closure(onto_df):
+    """
+    Build the transitive closure index of the ontologies in onto_df. For
+    each ontology it stores two lookups: term -> set of descendants and
+    term -> set of ancestors.
+    """
+    closure = {'descendants': {}, 'ancestors': {}}
+    for ontology, edges in onto_df.groupby('ontology'):
+        children = {}
+        parents = {}
+        for parent, child in zip(edges.parent_term, edges.child_term):
+            children.setdefault(parent, []).append(child)
+            parents.setdefault(child, []).append(parent)
+        closure['descendants'][ontology] = walk_graph(children)
+        closure['ancestors'][ontology] = walk_graph(parents)
+    return closure
+
+def load_closure(onto_fname, onto_df):
+    """
+    Load the closure index stored next to the ontology pickle, rebuilding
+    it if the ontology pickle has changed since it was generated.
+    """
+    closure_fname = os.path.join(os.path.dirname(onto_fname), closure_file)
+    stat = os.stat(onto_fname)
+    source = [stat.st_size, stat.st_mtime]
+    if os.path.isfile(closure_fname):
+        closure = pd.read_pickle(closure_fname)
+        if closure.get('source') == source:
+            return closure
+
+    closure = build_closure(onto_df)
+    closure['source'] = source
+    try:
+        pd.to_pickle(closure, closure_fname)
+    except (IOError, OSError):
+        sys.stderr.write('Could not store the ontology closure index in %s\n' %closure_fname)
+    return closure
+
+def related_terms(onto_closure, term, ontology, direction='descendants'):
+    """
+    Get the terms related to the given one in the ontology, either its
+    descendants or its ancestors, as a set.
+    """
+    return onto_closure[direction].get(ontology, {}).get(term, set())
+
+# Default directories of the ontology and 2016.1 data files, and of the 
+# normalisation lookup table
+data_dirs = {'data': os.path.join(os.path.dirname(__file__), 'data'),
+            'normalisation': os.path.join(os.path.dirname(__file__), '../data')}
+
+def data_file(args, fname, kind='data'):
+    """
+    Get the path of a data file in the data directory given in args, 
+    which holds all the data files, or else in the default directory of 
+    its kind
+    """
+    return os.path.join(args.data_dir or data_dirs[kind], fname)
+
+# Ontology dataframe and its transitive closure index of each ontology 
+# file, loaded on first use
 onto_file = 'ontology.pkl'
-fname = os.path.join(os.path.dirname(__file__), 'data',  onto_file)
-onto_df = pd.read_pickle(fname)
+closure_file = 'ontology_closure.pkl'
+ontology_data = {}
+
+def load_ontology(args):
+    """
+    Load the ontology dataframe and its transitive closure index from the
+    data directory in args, only reading them the first time they are 
+    needed
+    """
+    fname = data_file(args, onto_file)
+    if fname not in ontology_data:
+        onto_df = pd.read_pickle(fname)
+        ontology_data[fname] = (onto_df, load_closure(fname, onto_df))
+    return ontology_data[fname]
+
+# Findings of version 2016.1, and the directory where they are stored 
+# partitioned by normalised organ along with the index of the partitions
+find_file = 'findings.pkl.gz'
+partition_dir = 'findings_by_organ'
+partition_index_file = 'index.pkl'
+summary_file = 'summary.pkl'
+
+def build_partitions(find_fname, part_dir):
+    """
+    Split the findings pickle into an uncompressed pickle per normalised 
+    organ in part_dir. The index maps each organ (None for findings 
+    without organ) to the file of its partition and the studies it holds.
+    A summary of the findings of every organ is stored along with them.
+    """
+    find_df = pd.read_pickle(find_fname, compression='gzip')
+    codes, organs = pd.factorize(find_df.organ_normalised)
+    partitions = {}
+    for code, part_df in find_df.groupby(codes):
+        organ = organs[code] if code >= 0 else None
+        part_fname = 'part_%05d.pkl' %len(partitions)
+        part_df.reset_index(drop=True).to_pickle(os.path.join(part_dir, part_fname))
+        partitions[organ] = {'file': part_fname, 
+                            'study_ids': np.unique(part_df.study_id.values)}
+    summarise_findings(find_df).to_pickle(os.path.join(part_dir, summary_file))
+    return {'columns': list(find_df.columns), 'partitions': partitions, 
+            'summary': summary_file}
+
+def store_partitions(find_fname, part_dir, source):
+    """
+    Build the partitions of the findings pickle and their index in a 
+    temporary directory, and rename it to part_dir once complete, so that
+    concurrent runs never see them half written. The previous partitions,
+    if any, are replaced as a whole. Return the index.
+    """
+    data_dir = os.path.dirname(part_dir)
+    tmp_dir = tempfile.mkdtemp(prefix='.', dir=data_dir)
+    try:
+        index = build_partitions(find_fname, tmp_dir)
+        index['source'] = source
+        pd.to_pickle(index, os.path.join(tmp_dir, partition_index_file))
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # Move the previous partitions out of the way before renaming, as a 
+    # directory can only be renamed over an empty one
+    old_dir = tempfile.mkdtemp(prefix='.', dir=data_dir)
+    try:
+        os.rename(part_dir, old_dir)
+    except OSError:
+        # No previous partitions, or already replaced by a concurrent run
+        pass
+    try:
+        os.rename(tmp_dir, part_dir)
+    except OSError:
+        # Stored by a concurrent run
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        index = pd.read_pickle(os.path.join(part_dir, partition_index_file))
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return index
+
+def summarise_findings(find_df):
+    """
+    Keep, for each study and relevance, a finding with the minimum and one
+    with the maximum positive dose, or any finding if there is none, with
+    no organ nor observation. They give the same study counts and dose 
+    ranges per substance as all the findings, and are never expanded.
+    """
+    keys = ['study_id', 'relevance']
+    dosed = find_df[find_df.dose > 0].sort_values('dose', kind='mergesort')
+    summary = concat_frames([find_df.drop_duplicates(keys), 
+                            dosed.drop_duplicates(keys, keep='first'),
+                            dosed.drop_duplicates(keys, keep='last')])
+    summary = summary[keys+['dose']].drop_duplicates()
+    return summary.reindex(columns=find_df.columns).reset_index(drop=True)
+
+def load_partition_index(find_fname):
+    """
+    Load the index of the findings partitions stored next to the findings
+    pickle, splitting it again if the findings pickle has changed since 
+    they were generated. Return None if the partitions cannot be stored.
+    """
+    part_dir = os.path.join(os.path.dirname(find_fname), partition_dir)
+    index_fname = os.path.join(part_dir, partition_index_file)
+    stat = os.stat(find_fname)
+    source = [stat.st_size, stat.st_mtime]
+    if os.path.isfile(index_fname):
+        index = pd.read_pickle(index_fname)
+        if index.get('source') == source and 'summary' in index:
+            return index
+
+    try:
+        index = store_partitions(find_fname, part_dir, source)
+    except (IOError, OSError):
+        sys.stderr.write('Could not store the findings partitions in %s\n' %part_dir)
+        return None
+    return index
+
+def load_partitions(find_fname, organs, study_ids):
+    """
+    Load only the findings of the given organs and studies, reading the 
+    partitions of those organs that hold any of the studies, along with 
+    the summary of the findings of the studies, so that the stats per 
+    substance still count the findings of every organ. Return None if the
+    findings are not partitioned.
+    """
+    index = load_partition_index(find_fname)
+    if index is None:
+        return None
+    part_dir = os.path.join(os.path.dirname(find_fname), partition_dir)
+    summary_df = pd.read_pickle(os.path.join(part_dir, index['summary']))
+    frames = [summary_df[summary_df.study_id.isin(study_ids)]]
+    for organ in sorted(organs):
+        partition = index['partitions'].get(organ)
+        if partition is None or not np.isin(partition['study_ids'], study_ids).any():
+            continue
+        part_df = pd.read_pickle(os.path.join(part_dir, partition['file']))
+        frames.append(part_df[part_df.study_id.isin(study_ids)])
+    return concat_frames(frames)
+
+def term_closure(onto_closure, terms, ontology):
+    """
+    Get the given terms and all their descendants in the ontology
+    """
+    closure = set(terms)
+    for term in terms:
+        closure.update(related_terms(onto_closure, term, ontology))
+    return closure
+
+# Columns of the normalised study and findings dataframes
+study_columns = ['study_id', 'subst_id', 'normalised_sex',
+                'normalised_administration_route', 'normalised_species', 
+                'exposure_period_days']
+find_columns = ['study_id', 'relevance', 'observation_normalised', 
+                'organ_normalised', 'dose']
+
+# Queries to the Oracle database, along with the table they read and the 
+# columns they are loaded into
+study_query = ('STUDY_DESIGN', "SELECT SUBST_ID, SUBST_ID, STANDARDISED_SEX, STANDARDISED_ROUTE, \
+    STANDARDISED_SPECIES, EXPOSURE_PERIOD \
+    FROM STUDY_DESIGN \
+    JOIN SUBSTANCE_IDS ON STUDY_DESIGN.STRUCTURE_LUID = SUBSTANCE_IDS.LUID",
+    study_columns)
+finding_queries = [
+    ('HISTOPATHOLOGICALFI', "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
+        STANDARDISED_PATHOLOGY, STANDARDISED_ORGAN, DOSE \
+        FROM HISTOPATHOLOGICALFI \
+        WHERE STANDARDISED_PATHOLOGY IS NOT NULL \
+        AND STANDARDISED_ORGAN IS NOT NULL",
+        ['study_id', 'relevance', 'observation_normalised', 'organ_normalised', 'dose']),
+    ('CLINICALCHEMICALFIN', "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
+        FINDING, DOSE \
+        FROM CLINICALCHEMICALFIN",
+        ['study_id', 'relevance', 'observation_normalised', 'dose']),
+    ('CLINICALHEMATOLOGIC', "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
+        FINDING, DOSE \
+        FROM CLINICALHEMATOLOGIC",
+        ['study_id', 'relevance', 'observation_normalised', 'dose']),
+    ('ORGAN_WEIGHTS', "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
+        FINDING, STANDARDISED_ORGAN, DOSE \
+        FROM ORGAN_WEIGHTS",
+        ['study_id', 'relevance', 'observation_normalised', 'organ_normalised', 'dose'])
+]
+
+def normalise(values, normD, strict=False, exclude=True):
+    """
+    Normalise a column of raw terms with the normalisation lookup table.
+    Missing terms, and excluded terms if exclude is set, are replaced by 
+    an empty string. Otherwise, excluded terms are looked up as any other.
+    Terms not found in the lookup table raise a KeyError if strict is set,
+    and are kept as they are otherwise.
+    """
+    values = values.astype(object)
+    upper = values.str.upper()
+    excluded = upper.isnull()
+    if exclude:
+        excluded |= upper == 'EXCLUDED TERM'
+    normalised = upper.map(normD)
+    missing = normalised.isnull() & ~excluded
+    if strict and missing.any():
+        raise KeyError(upper[missing].iloc[0])
+    normalised[missing] = values[missing]
+    normalised[excluded] = ''
+    return normalised
+
+def normalise_studies(chunk, normD):
+    """
+    Normalise a chunk of rows from the study query
+    """
+    # Excluded sexes and routes are normalised with the lookup table, as 
+    # only excluded species are left empty
+    chunk['normalised_sex'] = normalise(chunk.normalised_sex, normD, strict=True, 
+                                        exclude=False)
+    chunk['normalised_administration_route'] = normalise(chunk.normalised_administration_route, 
+                                                        normD, strict=True, exclude=False)
+    chunk['normalised_species'] = normalise(chunk.normalised_species, normD, strict=True)
+    return chunk
+
+def normalise_findings(chunk, normD):
+    """
+    Normalise a chunk of rows from any of the findings queries. Findings
+    without organ get an empty organ.
+    """
+    chunk = chunk.reindex(columns=find_columns)
+    chunk['observation_normalised'] = normalise(chunk.observation_normalised, normD)
+    chunk['organ_normalised'] = normalise(chunk.organ_normalised, normD)
+    chunk['relevance'] = chunk.relevance.fillna('NA')
+    return chunk
+
+def inverse_normalisation(values, normD):
+    """
+    Get the raw terms that are normalised to any of the given values 
+    (case insensitive)
+    """
+    values = set([value.lower() for value in values])
+    return sorted([raw for raw, normalised in normD.items() 
+                    if raw != 'EXCLUDED TERM' and normalised.lower() in values])
+
+def build_study_filter(args, normD):
+    """
+    Translate the study design filters into WHERE clauses over the 
+    STUDY_DESIGN table and their bind parameters
+    """
+    clauses = []
+    binds = {}
+
+    # Exposure
+    if args.min_exposure is not None:
+        clauses.append('EXPOSURE_PERIOD >= :min_exposure')
+        binds['min_exposure'] = args.min_exposure
+    if args.max_exposure is not None:
+        clauses.append('EXPOSURE_PERIOD <= :max_exposure')
+        binds['max_exposure'] = args.max_exposure
+
+    # Administration route, species and study's level sex, matched against
+    # all the raw terms that are normalised to the requested ones
+    term_filters = [('STANDARDISED_ROUTE', 'route', args.route),
+                    ('STANDARDISED_SPECIES', 'species', args.species),
+                    ('STANDARDISED_SEX', 'sex', [args.sex] if args.sex else None)]
+    for column, name, values in term_filters:
+        if not values:
+            continue
+        raw_terms = inverse_normalisation(values, normD)
+        if not raw_terms:
+            # None of the requested terms can be found
+            clauses.append('1 = 0')
+            continue
+        names = ['%s%d' %(name, i) for i in range(len(raw_terms))]
+        clauses.append('UPPER(%s) IN (%s)' %(column, 
+                        ', '.join([':'+n for n in names])))
+        binds.update(zip(names, raw_terms))
+
+    return clauses, binds
+
+def restrict_query(query, clauses, binds, watermarks=None):
+    """
+    Add the WHERE clauses to a query. If watermarks are given, keep only
+    the rows of its table with a LUID above the table's watermark.
+    """
+    table, cmd, columns = query
+    if watermarks and watermarks.get(table) is not None:
+        clauses = clauses+['%s.LUID > :watermark' %table]
+        binds = dict(binds, watermark=watermarks[table])
+    if clauses:
+        conjunction = ' AND ' if ' WHERE ' in cmd else ' WHERE '
+        cmd = cmd + conjunction + ' AND '.join(clauses)
+    return cmd, columns, binds
+
+def fetch_normalised(cur, query, normalise_chunk, normD):
+    """
+    Run a query and stream its results by chunks of cur.arraysize rows, 
+    building and normalising a dataframe for each chunk
+    """
+    cmd, columns, binds = query
+    cur.execute(cmd, binds)
+    chunks = []
+    while True:
+        rows = cur.fetchmany()
+        if not rows:
+            break
+        chunk = pd.DataFrame.from_records(rows, columns=columns)
+        chunks.append(normalise_chunk(chunk, normD))
+    if not chunks:
+        return normalise_chunk(pd.DataFrame(columns=columns), normD)
+    return pd.concat(chunks, ignore_index=True)
+
+def concat_frames(frames):
+    """
+    Concatenate dataframes leaving out the empty ones, whose columns have 
+    no type and would turn the concatenated columns into objects
+    """
+    non_empty = [df for df in frames if len(df)]
+    return pd.concat(non_empty or frames[:1], ignore_index=True)
+
+def pooled_fetch_normalised(pool, arraysize, query, normalise_chunk, normD):
+    """
+    Run fetch_normalised on a session acquired from the pool
+    """
+    con = pool.acquire()
+    try:
+        cur = con.cursor()
+        cur.arraysize = arraysize
+        return fetch_normalised(cur, query, normalise_chunk, normD)
+    finally:
+        pool.release(con)
+
+class SQLitePool(object):
+
+    """
+    Stand-in for cx_Oracle.SessionPool on a SQLite database, opening a new
+    connection for each acquired session
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def acquire(self):
+        return sqlite3.connect(self.fname)
+
+    def release(self, con):
+        con.close()
+
+    def close(self):
+        pass
+
+def connect(args):
+    """
+    Connect to the Oracle database, or to its SQLite stand-in if given
+    """
+    if args.sqlite:
+        return sqlite3.connect(args.sqlite)
+    # The Oracle client is only needed to query the database
+    import cx_Oracle
+    return cx_Oracle.connect(args.user, args.passw)
+
+def open_pool(args, size):
+    """
+    Open a pool of sessions to the Oracle database, or to its SQLite
+    stand-in if given
+    """
+    if args.sqlite:
+        return SQLitePool(args.sqlite)
+    import cx_Oracle
+    dsn_tns = cx_Oracle.makedsn('localhost', '1521', args.sid)
+    return cx_Oracle.SessionPool(args.user, args.passw, dsn_tns, 
+                                1, size, 1, threaded=True)
+
+def query_watermarks(args):
+    """
+    Get the highest LUID of each queried table
+    """
+    con = connect(args)
+    cur = con.cursor()
+    watermarks = {}
+    for table, cmd, columns in [study_query]+finding_queries:
+        cur.execute('SELECT MAX(LUID) FROM %s' %table)
+        watermarks[table] = cur.fetchone()[0]
+    con.close()
+    return watermarks
+
+def query_database(args, pushdown=False, watermarks=None):
+
+    """
+    Query the Oracle database and generate the normalised study and
+    findings dataframes. If pushdown is set, the study design filters and
+    the treatment-related filter are applied by the database, so that only 
+    the relevant studies and their findings are loaded. If watermarks are
+    given, only the rows added to each table after its watermark are loaded.
+    """
+
+    # Load normlisation lookup table
+    norm_file = 'normalisation.pkl'
+    fname = data_file(args, norm_file, 'normalisation')
+    normD = pd.Series(pd.read_pickle(fname))
+
+    study_clauses = []
+    study_binds = {}
+    find_clauses = []
+    find_binds = {}
+    if pushdown:
+        study_clauses, study_binds = build_study_filter(args, normD)
+        if study_clauses:
+            # Keep only the findings of the relevant studies
+            find_clauses.append('PARENT_LUID IN (SELECT SUBST_ID FROM STUDY_DESIGN \
+                JOIN SUBSTANCE_IDS ON STUDY_DESIGN.STRUCTURE_LUID = SUBSTANCE_IDS.LUID \
+                WHERE %s)' %' AND '.join(study_clauses))
+            find_binds.update(study_binds)
+        if args.treatment_related:
+            find_clauses.append('RELEVANCE = :relevance')
+            find_binds['relevance'] = 'treatment related'
+    study_q = restrict_query(study_query, study_clauses, study_binds, watermarks)
+    find_qs = [restrict_query(query, find_clauses, find_binds, watermarks) 
+                for query in finding_queries]
+
+    if args.concurrent_queries:
+        # Run the study and findings queries at the same time, each one on
+        # its own session, and merge the findings in the queries' order
+        sys.stdout.write('\tLoading studies and findings\n')
+        n_queries = len(finding_queries)+1
+        pool = open_pool(args, n_queries)
+        with ThreadPoolExecutor(max_workers=n_queries) as executor:
+            study_job = executor.submit(pooled_fetch_normalised, pool, 
+                                        args.arraysize, study_q, 
+                                        normalise_studies, normD)
+            find_jobs = [executor.submit(pooled_fetch_normalised, pool, 
+                                        args.arraysize, query,
+                                        normalise_findings, normD)
+                        for query in find_qs]
+            study_df = study_job.result()
+            find_df = concat_frames([job.result() for job in find_jobs])
+        pool.close()
+    else:
+        con = connect(args)
+        cur = con.cursor()
+        cur.arraysize = args.arraysize
+
+        # Generate normalised study dataframe
+        sys.stdout.write('\tLoading studies\n')
+        study_df = fetch_normalised(cur, study_q, normalise_studies, normD)
+
+        # Generate normalised findings dataframe
+        sys.stdout.write('\tLoading findings\n')
+        find_df = concat_frames([fetch_normalised(cur, query, normalise_findings, normD) 
+                                for query in find_qs])
+
+        con.close()
+
+    return study_df,find_df
+
+def snapshot_source(args):
+    """
+    Describe the database a snapshot is extracted from
+    """
+    return {'version': args.version, 'sid': args.sid, 'user': args.user, 
+            'sqlite': args.sqlite}
+
+def read_manifest(fname):
+    """
+    Read the manifest of a snapshot
+    """
+    with open(fname+'.json') as f:
+        return json.load(f)
+
+def snapshot_is_valid(args):
+    """
+    Check whether the requested snapshot exists, was extracted from the 
+    same database and no full refresh has been requested
+    """
+    if not args.snapshot or args.refresh_snapshot:
+        return False
+    if not os.path.isfile(args.snapshot) or not os.path.isfile(args.snapshot+'.json'):
+        return False
+    return read_manifest(args.snapshot)['source'] == snapshot_source(args)
+
+def save_snapshot(fname, study_df, find_df, args, watermarks=None):
+    """
+    Store the normalised study and findings dataframes in an HDF5 file,
+    along with a JSON manifest describing its content and the highest 
+    LUID of each table it holds
+    """
+    study_df.to_hdf(fname, key='study', mode='w')
+    find_df.to_hdf(fname, key='findings', mode='a')
+    manifest = {'source': snapshot_source(args),
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'rows': {'study': len(study_df), 'findings': len(find_df)},
+                'watermarks': watermarks}
+    with open(fname+'.json', 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+def new_rows(df, new_df):
+    """
+    Keep the rows of new_df that are not already in df, comparing all the
+    columns
+    """
+    if df.empty or new_df.empty:
+        return new_df
+    merged = pd.merge(new_df, df.drop_duplicates(), how='left', on=list(df.columns), 
+                    indicator=True, sort=False)
+    return new_df[(merged['_merge'] == 'left_only').values]
+
+def refresh_snapshot(args):
+    """
+    Fetch the rows added to each table since the snapshot was stored, 
+    according to the highest LUID seen per table, and append them to the
+    snapshot. Rows fetched again, as they were added while the snapshot
+    was queried, are left out. The rows already in the snapshot are kept 
+    as they are. Updated or deleted rows are not detected and require a 
+    full refresh.
+    """
+    watermarks = read_manifest(args.snapshot).get('watermarks')
+    study_df, find_df = load_snapshot(args.snapshot)
+    # Read the new watermarks first, so that rows added while querying are
+    # fetched again on the next refresh rather than missed
+    new_watermarks = query_watermarks(args)
+    new_study_df, new_find_df = query_database(args, watermarks=watermarks)
+    new_study_df = new_rows(study_df, new_study_df)
+    new_find_df = new_rows(find_df, new_find_df)
+    sys.stdout.write('\tMerging %d studies and %d findings\n' 
+                    %(len(new_study_df), len(new_find_df)))
+    study_df = concat_frames([study_df, new_study_df])
+    find_df = concat_frames([find_df, new_find_df])
+    save_snapshot(args.snapshot, study_df, find_df, args, new_watermarks)
+    return study_df,find_df
+
+def load_snapshot(fname):
+    """
+    Load the normalised study and findings dataframes from an HDF5 file
+    """
+    study_df = pd.read_hdf(fname, key='study')
+    find_df = pd.read_hdf(fname, key='findings')
+    return study_df,find_df
+
+#######################
+# Memory-mapped store #
+#######################
+# Tables of the memory-mapped store and their directories
+store_tables = ['study', 'findings']
+
+def save_values(prefix, values):
+    """
+    Store an array of values, as a numpy file if they are numeric and as
+    a JSON list otherwise
+    """
+    if values.dtype == object:
+        with open(prefix+'.json', 'w') as f:
+            json.dump(list(values), f)
+    else:
+        np.save(prefix+'.npy', values)
+
+def open_values(prefix):
+    """
+    Open an array of values stored with save_values(), memory-mapping it 
+    if numeric
+    """
+    if os.path.isfile(prefix+'.npy'):
+        return np.load(prefix+'.npy', mmap_mode='r')
+    with open(prefix+'.json') as f:
+        return np.array(json.load(f), dtype=object)
+
+def save_table(table_dir, df, index):
+    """
+    Store each column of a dataframe in table_dir, categoricals as their 
+    codes and categories, along with the inverted indexes of the dataframe.
+    Return the description of the columns.
+    """
+    for dirname in [table_dir, os.path.join(table_dir, 'index')]:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    columns = []
+    for column in df.columns:
+        prefix = os.path.join(table_dir, column)
+        categorical = hasattr(df[column], 'cat')
+        if categorical:
+            np.save(prefix+'.codes.npy', df[column].cat.codes.values)
+            save_values(prefix+'.categories', 
+                        np.asarray(df[column].cat.categories, dtype=object))
+        else:
+            save_values(prefix, df[column].values)
+        columns.append({'name': column, 'categorical': categorical})
+    for column, column_index in index.items():
+        column_index.save(os.path.join(table_dir, 'index', column))
+    return columns
+
+def open_table(table_dir, columns):
+    """
+    Open a dataframe stored with save_table(), memory-mapping its numeric
+    columns and the codes of its categoricals, and its inverted indexes.
+    Return the dataframe and its indexes.
+    """
+    data = {}
+    index = {}
+    for column in columns:
+        name = column['name']
+        prefix = os.path.join(table_dir, name)
+        if column['categorical']:
+            data[name] = pd.Categorical.from_codes(np.load(prefix+'.codes.npy', mmap_mode='r'),
+                                                open_values(prefix+'.categories'))
+        else:
+            data[name] = open_values(prefix)
+        if name in value_columns:
+            index[name] = ValueIndex.open(os.path.join(table_dir, 'index', name))
+        elif name in range_columns:
+            index[name] = SortedIndex.open(os.path.join(table_dir, 'index', name))
+    df = pd.DataFrame(data, columns=[column['name'] for column in columns], 
+                    copy=False)
+    return df,index
+
+def save_store(dirname, study_df, find_df, indexes, args):
+    """
+    Store the compacted study and findings dataframes and their inverted 
+    indexes as a memory-mapped store, with a manifest.json describing 
+    its source and columns
+    """
+    manifest = {'source': snapshot_source(args),
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'tables': {}}
+    for table, df in zip(store_tables, [study_df, find_df]):
+        columns = save_table(os.path.join(dirname, table), df, indexes[table])
+        manifest['tables'][table] = {'rows': len(df), 'columns': columns}
+    # The manifest is written last, so that a store is complete once it
+    # has one
+    with open(os.path.join(dirname, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+def open_store(dirname, version):
+    """
+    Open the study and findings dataframes of a memory-mapped store, 
+    which concurrent processes share through the page cache, along with 
+    their inverted indexes
+    """
+    with open(os.path.join(dirname, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['source']['version'] != version:
+        raise Exception('The store %s holds version %s, not %s.' 
+                        %(dirname, manifest['source']['version'], version))
+    tables = {}
+    indexes = {}
+    for table in store_tables:
+        tables[table], indexes[table] = open_table(os.path.join(dirname, table), 
+                                                manifest['tables'][table]['columns'])
+    return tables['study'], tables['findings'], indexes
+
+def prepare(args):
+    """
+    Load the data of the requested version, from the data files, the 
+    Oracle database or a snapshot, and store it as a memory-mapped store
+    """
+    sys.stderr.write('\nLoading background information for version %s\n' %args.version)
+    study_df, find_df, indexes = load_version(args, pushdown=False)
+    sys.stderr.write('Storing %d studies and %d findings in %s\n' 
+                    %(len(study_df), len(find_df), args.prepare))
+    save_store(args.prepare, study_df, find_df, indexes, args)
+
+def load_version(args, pushdown=True):
+
+    """
+    Load tables with information, along with their inverted indexes. If 
+    pushdown is set, the filters in args can be applied when querying the 
+    Oracle database.
+    """
+
+    if args.store:
+        # Open the prepared tables, already compacted and indexed
+        sys.stdout.write('\tOpening store %s\n' %args.store)
+        return open_store(args.store, args.version)
+
+    if args.version == '2016.1':
+        ########################## 
+        # Load stored dataframes #
+        ##########################
+
+        # Load study dataframe
+        study_file = 'study.pkl'
+        fname = data_file(args, study_file)
+        study_df = pd.read_pickle(fname)
+        # Load finding dataframe
+        fname = data_file(args, find_file)
+        find_df = None
+        if pushdown and args.organ:
+            # Read only the partitions of the expanded organs, keeping the
+            # findings of the relevant studies
+            study_ids = filter_study(args, compact_studies(study_df)).study_id.values
+            organs = term_closure(load_ontology(args)[1], args.organ, 'anatomy')
+            find_df = load_partitions(fname, organs, study_ids)
+        if find_df is None:
+            find_df = pd.read_pickle(fname, compression='gzip')
+    else:
+        if snapshot_is_valid(args) and args.refresh_delta:
+            # Add the rows inserted since the previous extraction
+            sys.stdout.write('\tRefreshing snapshot %s\n' %args.snapshot)
+            study_df, find_df = refresh_snapshot(args)
+        elif snapshot_is_valid(args):
+            # Load the normalised tables from a previous extraction
+            sys.stdout.write('\tLoading snapshot %s\n' %args.snapshot)
+            study_df, find_df = load_snapshot(args.snapshot)
+        elif args.snapshot:
+            # A snapshot must hold every study, so filters are not pushed 
+            # down to the database
+            watermarks = query_watermarks(args)
+            study_df, find_df = query_database(args)
+            sys.stdout.write('\tStoring snapshot %s\n' %args.snapshot)
+            save_snapshot(args.snapshot, study_df, find_df, args, watermarks)
+        else:
+            study_df, find_df = query_database(args, pushdown=pushdown)
+
+    study_df, find_df = compact(study_df, find_df, load_ontology(args)[0])
+    return study_df,find_df,index_tables(study_df, find_df)
+
+def compact(study_df, find_df, onto_df):
+    """
+    Store the vocabulary columns of the study and findings dataframes as 
+    categoricals. Organs and observations share a single vocabulary with 
+    the terms of the ontology dataframe, so that they can be handled by 
+    their codes.
+    """
+    terms = set(onto_df.parent_term).union(onto_df.child_term)
+    for column in ['organ_normalised', 'observation_normalised']:
+        terms.update(find_df[column].dropna().unique())
+    vocabulary = pd.Index(sorted(terms))
+    for column in ['organ_normalised', 'observation_normalised']:
+        find_df[column] = pd.Categorical(find_df[column], categories=vocabulary)
+    find_df['relevance'] = find_df['relevance'].astype('category')
+    return compact_studies(study_df),find_df
+
+def index_tables(study_df, find_df):
+    """
+    Build the inverted indexes of the loaded study and findings dataframes,
+    by table name. They are kept along with the dataframes, which must not
+    be modified in place afterwards.
+    """
+    return {'study': table_index(study_df), 'findings': table_index(find_df)}
+
+def compact_studies(study_df):
+    """
+    Store the vocabulary columns of the study dataframe as categoricals
+    """
+    for column in ['normalised_sex', 'normalised_administration_route', 
+                    'normalised_species']:
+        study_df[column] = study_df[column].astype('category')
+    return study_df
+
+####################
+# Inverted indexes #
+####################
+class ValueIndex(object):
+
+    """
+    Inverted index of a column, mapping each of its values to the sorted
+    positions of the rows holding it. The positions of all the values are
+    stored in a single array, grouped by value, along with the offset of 
+    each value's group.
+    """
+
+    def __init__(self, values):
+        if hasattr(values, 'cat'):
+            codes = values.cat.codes.values
+            self.values = values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values, sort=True)
+            self.values = pd.Index(uniques)
+        # Missing values (code -1) are grouped first. A stable sort keeps 
+        # the positions of each value sorted.
+        self.positions = np.argsort(codes, kind='mergesort')
+        counts = np.bincount(codes+1, minlength=len(self.values)+1)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def save(self, prefix):
+        save_values(prefix+'.values', np.asarray(self.values))
+        np.save(prefix+'.positions.npy', self.positions)
+        np.save(prefix+'.offsets.npy', self.offsets)
+
+    @classmethod
+    def open(cls, prefix):
+        """
+        Open an index stored with save(), memory-mapping its positions
+        """
+        index = cls.__new__(cls)
+        index.values = pd.Index(open_values(prefix+'.values'))
+        index.positions = np.load(prefix+'.positions.npy', mmap_mode='r')
+        index.offsets = np.load(prefix+'.offsets.npy', mmap_mode='r')
+        return index
+
+    def lookup(self, values, lower=False):
+        """
+        Get the sorted positions of the rows holding any of the values, 
+        matched case insensitively if lower is set
+        """
+        if lower:
+            targets = [value.lower() for value in values]
+            codes = np.flatnonzero(self.values.str.lower().isin(targets))
+        else:
+            codes = self.values.get_indexer(list(values))
+            codes = np.unique(codes[codes >= 0])
+        groups = [self.positions[self.offsets[code+1]:self.offsets[code+2]] 
+                    for code in codes]
+        if not groups:
+            return np.array([], dtype=int)
+        return np.sort(np.concatenate(groups))
+
+class SortedIndex(object):
+
+    """
+    Index of a numeric column for range lookups, keeping the positions of
+    its non-missing rows sorted by value
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        valid = np.flatnonzero(~np.isnan(values))
+        order = np.argsort(values[valid], kind='mergesort')
+        self.positions = valid[order]
+        self.values = values[self.positions]
+
+    def save(self, prefix):
+        np.save(prefix+'.values.npy', self.values)
+        np.save(prefix+'.positions.npy', self.positions)
+
+    @classmethod
+    def open(cls, prefix):
+        """
+        Open an index stored with save(), memory-mapping its arrays
+        """
+        index = cls.__new__(cls)
+        index.values = np.load(prefix+'.values.npy', mmap_mode='r')
+        index.positions = np.load(prefix+'.positions.npy', mmap_mode='r')
+        return index
+
+    def lookup(self, minimum=None, maximum=None):
+        """
+        Get the sorted positions of the rows whose value is within the 
+        given bounds, both included
+        """
+        start = 0 if minimum is None else np.searchsorted(self.values, minimum, 'left')
+        end = len(self.values) if maximum is None else np.searchsorted(self.values, maximum, 'right')
+        return np.sort(self.positions[start:end])
+
+# Columns of the study and findings dataframes indexed by value, and by range
+value_columns = ['study_id', 'relevance', 'organ_normalised', 
+                'observation_normalised', 'normalised_sex', 
+                'normalised_administration_route', 'normalised_species']
+range_columns = ['exposure_period_days']
+
+def table_index(df):
+    """
+    Build the inverted indexes of the indexed columns of a dataframe
+    """
+    index = {}
+    for column in df.columns:
+        if column in value_columns:
+            index[column] = ValueIndex(df[column])
+        elif column in range_columns:
+            index[column] = SortedIndex(df[column].values)
+    return index
+
+def intersect(rows, other_rows):
+    """
+    Intersect two arrays of sorted row positions, None standing for all 
+    the rows
+    """
+    if rows is None:
+        return other_rows
+    return np.intersect1d(rows, other_rows, assume_unique=True)
+
+def filter_study(args,study_df,index=None):
+    """
+    Select the studies that pass the study design filters, intersecting 
+    the rows of each filter in the study dataframe's inverted indexes, 
+    which are built if not given
+    """
+    if index is None:
+        index = table_index(study_df)
+    rows = None
+
+    # Exposure
+    if args.min_exposure is not None or args.max_exposure is not None:
+        rows = index['exposure_period_days'].lookup(args.min_exposure, 
+                                                    args.max_exposure)
+
+    # Administration route
+    if args.route:
+        rows = intersect(rows, index['normalised_administration_route'].lookup(args.route, 
+                                                                            lower=True))
+        
+    # Species
+    if args.species:
+        rows = intersect(rows, index['normalised_species'].lookup(args.species, 
+                                                                lower=True))
+        
+    # Study's level sex
+    if args.sex:
+        rows = intersect(rows, index['normalised_sex'].lookup([args.sex], lower=True))
+    
+    if rows is None:
+        return study_df
+    return study_df.iloc[rows]
+
+def term_map(onto_closure, terms, ontology, vocabulary):
+    """
+    Build an array mapping the code of each term in the vocabulary to the
+    code of the given term it descends from in the ontology (or that is 
+    itself), and to -1 for unrelated terms. The extra last position maps 
+    the code of missing values (-1) to -1.
+    """
+    mapping = np.full(len(vocabulary)+1, -1, dtype=int)
+    for term in terms:
+        related = [term]+list(related_terms(onto_closure, term, ontology))
+        codes = vocabulary.get_indexer(related)
+        mapping[codes[codes >= 0]] = vocabulary.get_loc(term)
+    return mapping
+
+def expand(df,args):
+
+    """
+    Expand standardized observation and normalized organs based on
+    the hierarchy of ontologies stored in the ontology dataframe. Organs
+    and observations are handled by their codes in the vocabulary shared
+    by both categorical columns.
+    """
+    vocabulary = df['organ_normalised'].cat.categories
+    onto_closure = load_ontology(args)[1]
+       
+    #########
+    # ORGAN #
+    #########
+    organ_codes = term_map(onto_closure, args.organ, 'anatomy', vocabulary)[df['organ_normalised'].cat.codes.values]
+    df = df[organ_codes >= 0]
+    df['organ_normalised'] = pd.Categorical.from_codes(organ_codes[organ_codes >= 0], 
+                                                        vocabulary)
+
+   
+    ###############
+    # OBSERVATION #
+    ###############
+    observation_codes = df['observation_normalised'].cat.codes.values
+    if args.observation is None:
+
+        # Map each distinct observation to itself and its ancestors once, 
+        # and expand all the findings at once by joining them to this map
+        obs_map = []
+        for code in pd.unique(observation_codes):
+            obs_map.append((code, code))
+            if code < 0:
+                continue
+            parents = related_terms(onto_closure, vocabulary[code], 'histopathology', 'ancestors')
+            parents = [parent for parent in parents if parent != "morphologic change"]
+            for parent_code in vocabulary.get_indexer(parents):
+                obs_map.append((code, parent_code))
+        obs_map = pd.DataFrame(obs_map, columns=['observation_code', 
+                                                'expanded_code'])
+
+        findings_out = df.assign(observation_code=observation_codes)
+        findings_out = pd.merge(findings_out, obs_map, how='left', on='observation_code',
+                                left_index=False, right_index=False, sort=False)
+        findings_out['observation_normalised'] = pd.Categorical.from_codes(findings_out['expanded_code'].values, 
+                                                                            vocabulary)
+        findings_out = findings_out[df.columns]
+        findings_out.drop_duplicates(inplace=True)
+        
+    else:
+        observation_codes = term_map(onto_closure, args.observation, 
+                                    'histopathology', vocabulary)[observation_codes]
+        findings_out = df[observation_codes >= 0]
+        findings_out['observation_normalised'] = pd.Categorical.from_codes(observation_codes[observation_codes >= 0], 
+                                                                            vocabulary)
+
+    return findings_out
+
+def finding_names(organ_codes, observation_codes, vocabulary):
+    """
+    Build the organ_observation finding names from the codes of their
+    terms, naming missing terms as NA
+    """
+    names = np.append(vocabulary.values.astype(object), 'NA')
+    return pd.Series(names[organ_codes])+'_'+pd.Series(names[observation_codes])
+
+def get_stats(group):
+    return {'min': group.min(), 'max': group.max()}
+
+###########
+# Metrics #
+###########
+def peak_memory_mb(children=False):
+    """
+    Get the peak resident memory so far of the process, or of the largest
+    of its finished child processes if children is set, in MB
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak/1024.0/1024.0
+    return peak/1024.0
+
+def children_cpu_seconds():
+    """
+    Get the CPU time of the finished child processes, such as the workers
+    of a process pool once it is shut down
+    """
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime+usage.ru_stime
+
+class Metrics(object):
+
+    """
+    Record the wall time, CPU time, peak memory and input/output row counts
+    of each stage of a run. The CPU time of a stage includes that of the
+    worker processes it runs. Peak memory is a high-water mark, so each 
+    stage reports the peak of the process, and of its largest worker, so 
+    far rather than its own. The stage named in profile is run under 
+    cProfile and its stats are stored in profile_fname.
+    """
+
+    def __init__(self, profile=None, profile_fname=None):
+        self.stages = []
+        self.profile = profile
+        self.profile_fname = profile_fname
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        """
+        Measure the stage run in the with block. The block can set the
+        rows_out item of the yielded record.
+        """
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        profiler = None
+        if name == self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        wall = time.time()
+        cpu = time.process_time()
+        children_cpu = children_cpu_seconds()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = time.time()-wall
+            record['cpu_seconds'] = time.process_time()-cpu + \
+                                    children_cpu_seconds()-children_cpu
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_fname)
+                record['profile'] = self.profile_fname
+            record['peak_memory_so_far_mb'] = peak_memory_mb()
+            record['children_peak_memory_so_far_mb'] = peak_memory_mb(children=True)
+            self.stages.append(record)
+
+    def save(self, fname, args):
+        """
+        Write the metrics of the run as a JSON report
+        """
+        run_args = dict(vars(args))
+        run_args.pop('passw', None)
+        report = {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'args': run_args,
+                'stages': self.stages,
+                'wall_seconds': sum([s['wall_seconds'] for s in self.stages]),
+                'cpu_seconds': sum([s['cpu_seconds'] for s in self.stages]),
+                'peak_memory_mb': peak_memory_mb(),
+                'children_peak_memory_mb': peak_memory_mb(children=True)}
+        with open(fname, 'w') as f:
+            json.dump(report, f, indent=4)
+
+def relevant_rows(args, study_df, find_df, indexes):
+
+    """
+    Get the sorted positions of the findings of the studies that pass the
+    study filters, and only of the treatment-related ones if requested, 
+    from the inverted indexes of the dataframes
+    """
+
+    relevant_studies_df = filter_study(args,study_df,indexes['study'])
+    index = indexes['findings']
+    rows = index['study_id'].lookup(relevant_studies_df.study_id.values)
+    if args.treatment_related:
+        rows = intersect(rows, index['relevance'].lookup(['treatment related']))
+    return rows
+
+def expansion_rows(args, rows, index):
+
+    """
+    Narrow the sorted positions of the relevant findings to those whose 
+    organ, and observation if filtered for, is one of the requested terms
+    or their descendants in the ontologies, from the findings dataframe's
+    inverted indexes
+    """
+
+    onto_closure = load_ontology(args)[1]
+    rows = intersect(rows, index['organ_normalised'].lookup(term_closure(onto_closure, 
+                                                                        args.organ, 'anatomy')))
+    if args.observation is not None:
+        rows = intersect(rows, index['observation_normalised'].lookup(term_closure(onto_closure, 
+                                                                                args.observation, 
+                                                                                'histopathology')))
+    return rows
+
+def relevant_findings(args, study_df, find_df, rows=None, indexes=None):
+
+    """
+    Select the findings of the studies that pass the study filters, and 
+    only the treatment-related ones if requested, adding their substance.
+    The positions of these findings can be given if already known, and 
+    otherwise they are looked up in the inverted indexes of the dataframes,
+    which are built if not given.
+    """
+
+    if rows is None:
+        if indexes is None:
+            indexes = index_tables(study_df, find_df)
+        rows = relevant_rows(args, study_df, find_df, indexes)
+    relevant_find = find_df.iloc[rows]
+    relevant_find = pd.merge(relevant_find, study_df[['study_id', 'subst_id']],
+                        how='left', on='study_id', left_index=False,
+                        right_index=False, sort=False)
+    return relevant_find
+
+def aggregate(args, study_df, find_df, metrics=None, indexes=None):
+
+    """
+    Aggregate the loaded study and findings dataframes, based on the parsed
+    filters and expanding based on the organs and morphological changes 
+    ontologies. The inverted indexes of the dataframes are built if not 
+    given. Return the stats per substance and the minimum dose of each
+    substance/finding instance in long format.
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+    if indexes is None:
+        indexes = index_tables(study_df, find_df)
+    if args.jobs > 1:
+        return aggregate_parallel(args, study_df, find_df, metrics, indexes)[:2]
+
+    #################################
+    # Select only relevant findings #
+    #################################
+    sys.stderr.write('Filtering to relevant information\n')
+    with metrics.stage('filter', len(find_df)) as record:
+        rows = relevant_rows(args, study_df, find_df, indexes)
+        relevant_find = relevant_findings(args, study_df, find_df, rows)
+        record['rows_out'] = len(relevant_find)
+    
+    ###################################
+    # Get stats for relevant findings #
+    ###################################
+    with metrics.stage('stats', len(relevant_find)) as record:
+        stats_df = substance_stats(relevant_find)
+        record['rows_out'] = len(stats_df)
+
+    ###################################################################
+    # Expand based on anatomical and morphological changes ontologies #
+    ###################################################################
+    # Expand organs and histopathological findings according to the ontologies 
+    # and filter by finding-based arguments
+    sys.stderr.write('Expand based on anatomic and morphological change ontologies\n')
+    with metrics.stage('expand', len(relevant_find)) as record:
+        # Expand only the relevant findings of the requested organs and 
+        # observations, selected in find_df before adding their substance
+        expand_find = relevant_findings(args, study_df, find_df, 
+                                        expansion_rows(args, rows, indexes['findings']))
+        filtered_find = expand(expand_find,args)
+        record['rows_out'] = len(filtered_find)
+
+    if filtered_find.empty:
+        raise EmptyExtraction('Filtered out all rows, so the dataframe is empty.')
+
+    ######################################
+    # Aggragate by substance and finding #
+    ######################################
+    with metrics.stage('group', len(filtered_find)) as record:
+        group_df = min_doses(filtered_find)
+        record['rows_out'] = len(group_df)
+
+    return stats_df, group_df
+
+class EmptyExtraction(Exception):
+
+    """
+    Raised when no findings are left after filtering
+    """
+
+def substance_stats(relevant_find, keys=['subst_id']):
+
+    """
+    Get the number of studies and the dose range of the relevant findings
+    per substance, or per group of the given keys
+    """
+
+    if relevant_find.empty:
+        raise EmptyExtraction('No findings are left after filtering.')
+
+    # Get the number of studies per substance
+    count_df = relevant_find.groupby(keys).study_id.nunique().to_frame().reset_index()
+    # Get the global dose range per substance
+    range_df = relevant_find[relevant_find.dose > 0]
+    range_df = range_df.groupby(keys).dose.apply(get_stats).unstack().reset_index()
+    # Get all stats into a single dataframe
+    stats_df = pd.merge(count_df, range_df, how='inner', on=keys, 
+                        left_index=False, right_index=False, sort=False)
+    stats_df.columns = keys+['study_count', 'dose_max', 'dose_min']
+    return stats_df
+
+def min_doses(filtered_find, keys=['subst_id']):
+
+    """
+    Get the minimum dose of each substance/finding instance among the 
+    expanded findings, or of each instance within the groups of the given
+    keys
+    """
+
+    # Define finding as the pair of organ and observation codes
+    vocabulary = filtered_find.organ_normalised.cat.categories
+    filtered_find['organ_code'] = filtered_find.organ_normalised.cat.codes
+    filtered_find['observation_code'] = filtered_find.observation_normalised.cat.codes
+    filtered_find = filtered_find[keys+['organ_code', 'observation_code', 'dose']]
+
+    # Aggregate by substance and finding (as defined above), keeping the minimum dose 
+    # for each substance/finding instance
+    group_df = filtered_find.groupby(keys+['organ_code', 'observation_code']).min().add_prefix('min_').reset_index()
+    # Name the findings as organ_observation
+    group_df['finding'] = finding_names(group_df.organ_code.values, 
+                                        group_df.observation_code.values, vocabulary)
+    return group_df[keys+['finding', 'min_dose']]
+
+########################
+# Parallel aggregation #
+########################
+# Columns of the pivoted results before the findings
+result_columns = ['subst_id', 'study_count', 'dose_max', 'dose_min', 'is_active']
+
+def partition_results(args, relevant_find, expand_find, pivot=False):
+
+    """
+    Aggregate the relevant findings of a partition of the substances, as 
+    aggregate() does, expanding only the findings in expand_find. If pivot
+    is set, also pivot them into the quantitative and qualitative tables.
+    """
+
+    stats_df = substance_stats(relevant_find)
+    filtered_find = expand(expand_find, args)
+    if filtered_find.empty:
+        group_df = pd.DataFrame(columns=['subst_id', 'finding', 'min_dose'])
+    else:
+        group_df = min_doses(filtered_find)
+    if not pivot:
+        return stats_df, group_df
+    if group_df.empty:
+        # None of the substances is active
+        quantitative_df = stats_df.copy()
+        quantitative_df['is_active'] = 'False'
+        return stats_df, group_df, quantitative_df, quantitative_df.copy()
+    return (stats_df, group_df)+pivot_results(stats_df, group_df.copy())
+
+def concat_results(frames, key):
+    """
+    Concatenate the results of the partitions, sorted by the key
+    """
+    return concat_frames(frames).sort_values(key).reset_index(drop=True)
+
+def concat_pivots(frames):
+    """
+    Concatenate the pivoted results of the partitions, sorting the rows by
+    substance and the finding columns by name as pivot_results() does
+    """
+    df = concat_results(frames, 'subst_id')
+    findings = sorted([column for column in df.columns if column not in result_columns])
+    return df[result_columns+findings]
+
+def substance_partitions(df, jobs):
+    """
+    Hash the substance of each row into one of jobs partitions
+    """
+    return pd.util.hash_array(np.asarray(df.subst_id)) % np.uint64(jobs)
+
+def aggregate_parallel(args, study_df, find_df, metrics, indexes, pivot=False):
+
+    """
+    Aggregate the loaded study and findings dataframes on a pool of 
+    args.jobs processes. The relevant findings are hash-partitioned by
+    substance, and the stats, the expansion, the minimum doses and, if 
+    pivot is set, the pivots of each partition are computed by its own 
+    process. Return the stats and minimum doses, and the quantitative and
+    qualitative tables if pivot is set.
+    """
+
+    sys.stderr.write('Filtering to relevant information\n')
+    with metrics.stage('filter', len(find_df)) as record:
+        rows = relevant_rows(args, study_df, find_df, indexes)
+        relevant_find = relevant_findings(args, study_df, find_df, rows)
+        # The findings of the requested organs and observations
+        expand_find = relevant_findings(args, study_df, find_df, 
+                                        expansion_rows(args, rows, indexes['findings']))
+        record['rows_out'] = len(relevant_find)
+
+    sys.stderr.write('Aggregating %d partitions of substances\n' %args.jobs)
+    with metrics.stage('aggregate', len(relevant_find)) as record:
+        partitions = substance_partitions(relevant_find, args.jobs)
+        expand_partitions = substance_partitions(expand_find, args.jobs)
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            jobs = []
+            for partition in np.unique(partitions):
+                jobs.append(executor.submit(partition_results, args, 
+                                            relevant_find[partitions == partition], 
+                                            expand_find[expand_partitions == partition],
+                                            pivot))
+            results = [job.result() for job in jobs]
+        if not results or all([result[1].empty for result in results]):
+            raise EmptyExtraction('Filtered out all rows, so the dataframe is empty.')
+        stats_df = concat_results([result[0] for result in results], 'subst_id')
+        group_df = concat_results([result[1] for result in results], 
+                                ['subst_id', 'finding'])
+        record['rows_out'] = len(group_df)
+    if not pivot:
+        return stats_df, group_df, None, None
+
+    with metrics.stage('pivot', len(group_df)) as record:
+        quantitative_df = concat_pivots([result[2] for result in results])
+        qualitative_df = concat_pivots([result[3] for result in results])
+        record['rows_out'] = len(quantitative_df)
+    return stats_df, group_df, quantitative_df, qualitative_df
+
+def extract_results(args, study_df, find_df, metrics=None, indexes=None):
+
+    """
+    Extract the quantitative and qualitative results from the loaded study
+    and findings dataframes, based on the parsed filters and expanding
+    based on the organs and morphological changes ontologies. The inverted
+    indexes of the dataframes are built if not given.
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+    if indexes is None:
+        indexes = index_tables(study_df, find_df)
+    if args.jobs > 1:
+        results = aggregate_parallel(args, study_df, find_df, metrics, indexes, 
+                                    pivot=True)
+        return results[2:]
+    stats_df, group_df = aggregate(args, study_df, find_df, metrics, indexes)
+    with metrics.stage('pivot', len(group_df)) as record:
+        quantitative_df, qualitative_df = pivot_results(stats_df, group_df)
+        record['rows_out'] = len(quantitative_df)
+    return quantitative_df, qualitative_df
+
+def pivot_results(stats_df, group_df):
+
+    """
+    Pivot the minimum dose of each substance/finding instance into the 
+    quantitative and qualitative substance x finding dataframes
+    """
+    
+    #######################################
+    # Pivot so that each finding is a row #
+    #######################################
+    ### Quantitative
+    pivotted_df = group_df.pivot_table(index='subst_id', columns='finding', values='min_dose').reset_index()
+    pivotted_df['is_active'] = 'True'
+    quantitative_df = pd.merge(stats_df, pivotted_df, how='left', on='subst_id', 
+                                left_index=False, right_index=False, sort=False)
+    quantitative_df.is_active = quantitative_df.is_active.fillna('False')
+    # Reorder columns
+    cols = quantitative_df.columns.tolist()
+    cols = cols[0:4]+[cols[-1]]+cols[4:-1]
+    quantitative_df = quantitative_df[cols]
+    
+    ### Qualitative
+    group_df.loc[:,'min_dose'] = 1
+    pivotted_df = group_df.pivot_table(index='subst_id', columns='finding', values='min_dose').reset_index()
+    pivotted_df['is_active'] = 'True'
+    qualitative_df = pd.merge(stats_df, pivotted_df, how='left', on='subst_id',
+                                left_index=False, right_index=False, sort=False)
+    qualitative_df.is_active = qualitative_df.is_active.fillna('False')
+    # Reorder columns
+    cols = qualitative_df.columns.tolist()
+    cols = cols[0:4]+[cols[-1]]+cols[4:-1]
+    qualitative_df = qualitative_df[cols]
+
+    return quantitative_df, qualitative_df
+
+# Extension of the output files of each output format, and number of rows
+# written at a time
+output_formats = {'tsv': '.tsv', 'tsv.gz': '.tsv.gz', 'parquet': '.parquet',
+                'feather': '.feather', 'hdf5': '.h5'}
+chunk_rows = 10000
+# Optional modules required to write each output format
+format_modules = {'parquet': 'pyarrow', 'feather': 'pyarrow', 'hdf5': 'tables'}
+
+def check_output_format(output_format):
+    """
+    Check that the module required to write the output format is 
+    installed, before loading any data
+    """
+    module = format_modules.get(output_format)
+    if module is None:
+        return
+    try:
+        __import__(module)
+    except ImportError:
+        raise argparse.ArgumentTypeError('The %s output format requires %s, '
+                                        'which is not installed.' %(output_format, module))
+
+def write_table(df, fname, output_format):
+    """
+    Write a results table in the given output format. TSV and Parquet 
+    files are written by chunks of chunk_rows rows.
+    """
+    if output_format == 'tsv':
+        df.to_csv(fname, sep='\t', index=False, chunksize=chunk_rows)
+    elif output_format == 'tsv.gz':
+        df.to_csv(fname, sep='\t', index=False, chunksize=chunk_rows, 
+                compression='gzip')
+    elif output_format == 'hdf5':
+        df.to_hdf(fname, key='results', mode='w')
+    else:
+        # pyarrow is only needed to write Parquet and Feather files
+        import pyarrow
+        df = df.reset_index(drop=True)
+        if output_format == 'feather':
+            import pyarrow.feather
+            pyarrow.feather.write_feather(df, fname)
+            return
+        import pyarrow.parquet
+        schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+        writer = pyarrow.parquet.ParquetWriter(fname, schema)
+        try:
+            for start in range(0, max(len(df), 1), chunk_rows):
+                chunk = pyarrow.Table.from_pandas(df.iloc[start:start+chunk_rows], 
+                                                schema=schema, preserve_index=False)
+                writer.write_table(chunk)
+        finally:
+            writer.close()
+
+def save_tables(args, tables):
+    """
+    Write the (name, dataframe) results tables at the same time, each one
+    to the output base name followed by its name and the extension of the
+    output format. HDF5 files are written one at a time, as the HDF5 
+    library is not thread-safe.
+    """
+    extension = output_formats[args.output_format]
+    workers = 1 if args.output_format == 'hdf5' else len(tables)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(write_table, df, args.output_basename+name+extension, 
+                                args.output_format) 
+                for name, df in tables]
+        for job in jobs:
+            job.result()
+
+def save_results(args, quantitative_df, qualitative_df):
+
+    """
+    Save the quantitative and qualitative results
+    """
+
+    save_tables(args, [('_quant', quantitative_df), ('_qual', qualitative_df)])
+
+def active_stats(stats_df, group_df):
+    """
+    Add the is_active column to the stats per substance
+    """
+    stats_df = stats_df.copy()
+    stats_df['is_active'] = stats_df.subst_id.isin(group_df.subst_id).map({True: 'True', 
+                                                                            False: 'False'})
+    return stats_df
+
+def reported_findings(stats_df, group_df, keys=['subst_id']):
+    """
+    Keep the substance/finding instances of the substances with stats, or
+    of the groups of the given keys with stats, as the dense layout only 
+    reports the substances with stats
+    """
+    reported = pd.MultiIndex.from_arrays([stats_df[key] for key in keys])
+    instances = pd.MultiIndex.from_arrays([group_df[key] for key in keys])
+    return group_df[instances.isin(reported)]
+
+def save_long(args, stats_df, group_df):
+
+    """
+    Save the results in long format: the stats per substance and a row per
+    substance/finding instance with its minimum dose. Instances not listed
+    are not reported.
+    """
+
+    group_df = reported_findings(stats_df, group_df)
+    save_tables(args, [('_stats', active_stats(stats_df, group_df)), 
+                    ('_findings', group_df.sort_values(['subst_id', 'finding']))])
+
+def save_sparse(args, stats_df, group_df):
+
+    """
+    Save the results as a sparse substance x finding matrix of minimum 
+    doses in MatrixMarket coordinate format. Rows follow the substances
+    in the stats file and columns the findings in the findings file. Every
+    stored entry, including zero doses, is a reported finding.
+    """
+
+    group_df = reported_findings(stats_df, group_df)
+    stats_df = active_stats(stats_df, group_df)
+    findings = pd.Index(sorted(group_df.finding.unique()))
+    rows = pd.Index(stats_df.subst_id).get_indexer(group_df.subst_id)
+    cols = findings.get_indexer(group_df.finding)
+    entries = pd.DataFrame({'row': rows+1, 'col': cols+1, 
+                            'min_dose': group_df.min_dose.values})
+    entries = entries.sort_values(['row', 'col'])
+
+    stats_df.to_csv(args.output_basename+'_stats.tsv', sep='\t', index=False)
+    pd.Series(findings).to_csv(args.output_basename+'_findings.txt', 
+                                index=False, header=False)
+    with open(args.output_basename+'_quant.mtx', 'w') as f:
+        f.write('%%MatrixMarket matrix coordinate real general\n')
+        f.write('%d %d %d\n' %(len(stats_df), len(findings), len(entries)))
+        entries.to_csv(f, sep=' ', index=False, header=False)
+
+def run_query(args, study_df, find_df, metrics=None, indexes=None):
+
+    """
+    Run the extraction on the loaded dataframes, with their inverted 
+    indexes if given, and save its results in the requested output layout
+    """
+
+    if metrics is None:
+        metrics = Metrics()
+    if args.output_layout == 'dense':
+        quantitative_df, qualitative_df = extract_results(args, study_df, find_df, 
+                                                        metrics, indexes)
+        with metrics.stage('write', len(quantitative_df)):
+            save_results(args, quantitative_df, qualitative_df)
+    else:
+        stats_df, group_df = aggregate(args, study_df, find_df, metrics, indexes)
+        with metrics.stage('write', len(group_df)):
+            if args.output_layout == 'long':
+                save_long(args, stats_df, group_df)
+            else:
+                save_sparse(args, stats_df, group_df)
+
+################
+# Result cache #
+################
+def output_files(args):
+    """
+    Get the output files of the requested layout and format, by their 
+    suffix to the output base name
+    """
+    if args.output_layout == 'sparse':
+        return ['_stats.tsv', '_findings.txt', '_quant.mtx']
+    names = ['_quant', '_qual'] if args.output_layout == 'dense' else ['_stats', '_findings']
+    return [name+output_formats[args.output_format] for name in names]
+
+def data_fingerprint(args):
+    """
+    Describe the data an extraction runs on without loading it: the size
+    and modification time of the ontology and of the data files or the 
+    snapshot manifest, or the database and the highest LUID of each table
+    when querying it directly. Updated or deleted rows in the database are
+    not detected.
+    """
+    fnames = [data_file(args, onto_file)]
+    database = None
+    if args.store:
+        fnames.append(os.path.join(args.store, 'manifest.json'))
+    elif args.version == '2016.1':
+        fnames += [data_file(args, 'study.pkl'), data_file(args, find_file)]
+    elif args.snapshot:
+        fnames.append(args.snapshot+'.json')
+    else:
+        fnames.append(data_file(args, 'normalisation.pkl', 'normalisation'))
+        database = {'source': snapshot_source(args), 
+                    'watermarks': query_watermarks(args)}
+    files = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        files.append([os.path.abspath(fname), stat.st_size, stat.st_mtime])
+    return {'version': args.version, 'files': files, 'database': database}
+
+def snapshot_changes(args):
+    """
+    Check whether loading the data rewrites the snapshot, so that its 
+    fingerprint is only known after loading it
+    """
+    return args.version == '2016.2' and not args.store and bool(args.snapshot) and \
+        (args.refresh_delta or not snapshot_is_valid(args))
+
+class ResultCache(object):
+
+    """
+    On-disk cache of the output files of the extractions, with an entry 
+    directory per query and data fingerprint. Once the entries take more
+    than max_mb, the least recently used ones are evicted.
+    """
+
+    def __init__(self, cache_dir, max_mb):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb*1024*1024
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, args, fingerprint):
+        """
+        Hash the filters of a query, with the organs and observations
+        already resolved to the ontology terms, its output layout and the
+        data fingerprint
+        """
+        query = {}
+        for arg in ['organ', 'observation', 'route', 'species']:
+            values = getattr(args, arg)
+            query[arg] = sorted(values) if values is not None else None
+        for arg in ['min_exposure', 'max_exposure', 'sex', 'treatment_related', 
+                    'output_layout', 'output_format']:
+            query[arg] = getattr(args, arg)
+        text = json.dumps([query, fingerprint], sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def fetch(self, args, fingerprint):
+        """
+        Copy the cached output files of the query to its output base name.
+        Return whether they were cached.
+        """
+        entry = os.path.join(self.cache_dir, self.key(args, fingerprint))
+        if not os.path.isdir(entry):
+            return False
+        for suffix in output_files(args):
+            shutil.copyfile(os.path.join(entry, suffix), args.output_basename+suffix)
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return True
+
+    def store(self, args, fingerprint):
+        """
+        Store the output files of the query, and evict the least recently
+        used entries if the cache is full
+        """
+        entry = os.path.join(self.cache_dir, self.key(args, fingerprint))
+        # Fill the entry in a temporary directory, so that concurrent 
+        # queries never see it half written
+        tmp_dir = tempfile.mkdtemp(prefix='.', dir=self.cache_dir)
+        for suffix in output_files(args):
+            shutil.copyfile(args.output_basename+suffix, os.path.join(tmp_dir, suffix))
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry)
+        except OSError:
+            # Stored by a concurrent query
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in 
+        its size limit
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum([os.path.getsize(os.path.join(entry, f)) 
+                            for f in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # Evicted by a concurrent query
+                continue
+        total = sum([size for used, size, entry in entries])
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+def open_cache(args):
+    """
+    Open the result cache, if requested
+    """
+    if not args.result_cache:
+        return None
+    return ResultCache(args.result_cache, args.cache_size)
+
+def run(args):
+
+    """
+    Run the data extraction based on the parsed filters and expanding
+    based on the organs and morphological changes ontologies.
+    """
+
+    metrics = Metrics(args.profile, args.profile_output)
+
+    cache = open_cache(args)
+    if cache and not args.bypass_cache and not snapshot_changes(args):
+        with metrics.stage('cache') as record:
+            hit = cache.fetch(args, data_fingerprint(args))
+        if hit:
+            sys.stderr.write('\nResults found in the cache\n')
+            if args.metrics:
+                metrics.save(args.metrics, args)
+            return
+
+    sys.stderr.write('\nLoading background information for version %s\n' %args.version)
+    with metrics.stage('load') as record:
+        study_df, find_df, indexes = load_version(args)
+        record['rows_out'] = len(find_df)
+    
+    ################################
+    # Extract and save the results #
+    ################################
+    run_query(args, study_df, find_df, metrics, indexes)
+    if cache:
+        cache.store(args, data_fingerprint(args))
 
-def load_version(args):
+    if args.metrics:
+        metrics.save(args.metrics, args)
 
+#############
+# Grid mode #
+#############
+# Study columns the grid can be stratified by
+strata_columns = {'species': 'normalised_species', 
+                'route': 'normalised_administration_route'}
+
+def exposure_bin(text):
     """
-    Load tables with information
+    Parse an exposure bin given as MIN-MAX, MIN- or -MAX days into its 
+    bounds, None standing for an open bound
     """
+    try:
+        minimum, maximum = text.split('-')
+        return (int(minimum) if minimum else None, int(maximum) if maximum else None)
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid exposure bin %s, expected '
+                                        'MIN-MAX, MIN- or -MAX days.' %text)
 
-    if args.version == '2016.1':
-        ########################## 
-        # Load stored dataframes #
-        ##########################
+def bin_label(bounds):
+    """
+    Name an exposure bin as given in the command line
+    """
+    return '-'.join(['' if bound is None else str(bound) for bound in bounds])
 
-        # Load study dataframe
-        study_file = 'study.pkl'
-        fname = os.path.join(os.path.dirname(__file__), 
-                            'data',  study_file)
-        study_df = pd.read_pickle(fname)
-        # Load finding dataframe
-        find_file = 'findings.pkl.gz'
-        fname = os.path.join(os.path.dirname(__file__), 
-                            'data',  find_file)
-        find_df = pd.read_pickle(fname, compression='gzip')
-    else:
-        #########################################
-        # Query the Oracle database to generate #
-        # the dataframes                        #
-        #########################################
+def study_strata(args, study_df, index=None):
 
-        # Load normlisation lookup table
-        norm_file = 'normalisation.pkl'
-        fname = os.path.join(os.path.dirname(__file__), 
-                            '../data',  norm_file)
-        normD = pd.read_pickle(fname)
+    """
+    Tag the studies that pass the study filters with the strata of the 
+    grid they fall into, named as exposure=MIN-MAX;species=SPECIES;... 
+    A study falls into as many strata as the exposure bins that hold it.
+    """
 
-        dsn_tns = cx_Oracle.makedsn('localhost', '1521', args.sid)
+    relevant_studies_df = filter_study(args, study_df, index)
+    frames = []
+    for bounds in args.exposure_bins or [None]:
+        studies_df = relevant_studies_df
+        labels = pd.Series('', index=studies_df.index)
+        if bounds is not None:
+            exposure = studies_df.exposure_period_days
+            in_bin = exposure.notnull()
+            if bounds[0] is not None:
+                in_bin &= exposure >= bounds[0]
+            if bounds[1] is not None:
+                in_bin &= exposure <= bounds[1]
+            studies_df = studies_df[in_bin]
+            labels = pd.Series('exposure=%s;' %bin_label(bounds), index=studies_df.index)
+        for stratum in args.strata or []:
+            labels = labels+stratum+'='+studies_df[strata_columns[stratum]].astype(str)+';'
+        frames.append(pd.DataFrame({'study_id': studies_df.study_id.values, 
+                                    'stratum': labels.str[:-1].values},
+                                    columns=['study_id', 'stratum']))
+    return concat_frames(frames).drop_duplicates()
 
-        con = cx_Oracle.connect(args.user, args.passw)
-        cur = con.cursor()
+def aggregate_grid(args, study_df, find_df, metrics=None, indexes=None):
 
-        # Generate normalised study dataframe
-        sys.stdout.write('\tLoading studies\n')
-        cmd = "SELECT SUBST_ID, SUBST_ID, STANDARDISED_SEX, STANDARDISED_ROUTE, \
-            STANDARDISED_SPECIES, EXPOSURE_PERIOD \
-            FROM STUDY_DESIGN \
-            JOIN SUBSTANCE_IDS ON STUDY_DESIGN.STRUCTURE_LUID = SUBSTANCE_IDS.LUID"
-        cur.execute(cmd)
-        results = cur.fetchall()
-        tmp_table = []
-        for (study_id, subst_id, sex, route, species, exposure) in results:
-             sex = sex.upper()
-             sex = normD[sex]
-             if route is None:
-                 route = ''
-             else:
-                 route = route.upper()
-                 route = normD[route]
-             if species is None or species.upper() in ('EXCLUDED TERM'):
-                 species = ''
-             else:
-                 species = species.upper()
-                 species = normD[species]
-             tmp_table.append([study_id, subst_id, sex, route, species, exposure])
-        study_df = pd.DataFrame(tmp_table, columns=['study_id', 'subst_id', 'normalised_sex',
-                        'normalised_administration_route', 'normalised_species', 'exposure_period_days'])
+    """
+    Aggregate the loaded study and findings dataframes as aggregate() does,
+    for every stratum of the grid at once. The findings are expanded once,
+    and the stats and minimum doses are grouped by stratum and substance.
+    """
 
-        # Generate normalised findings dataframe
-        sys.stdout.write('\tLoading findings\n')
-        cmd = "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
-            STANDARDISED_PATHOLOGY, STANDARDISED_ORGAN, DOSE \
-            FROM HISTOPATHOLOGICALFI \
-            WHERE STANDARDISED_PATHOLOGY IS NOT NULL \
-            AND STANDARDISED_ORGAN IS NOT NULL"
-        cur.execute(cmd)
-        results = cur.fetchall()
-        tmp_table = []
-        for (study_id, relevance, observation, organ, dose) in results:
-             if observation is None or observation.upper() == 'EXCLUDED TERM':
-                 observation = ''
-             else:
-                 observation_upper = observation.upper()
-                 if observation_upper in normD:
-                     observation = normD[observation_upper]
- 
-             if organ is None or organ.upper() == 'EXCLUDED TERM':
-                 organ = ''
-             else:
-                 organ_upper = organ.upper()
-                 if organ_upper in normD:
-                     organ = normD[organ_upper]
-             
-             if relevance is None:
-                 relevance = 'NA'
-             tmp_table.append([study_id, relevance, observation, organ, dose])
-        
-        cmd = "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
-            FINDING, DOSE \
-            FROM CLINICALCHEMICALFIN"
-        cur.execute(cmd)
-        results = cur.fetchall()
-        for (study_id, relevance, observation, dose) in results:
-             if observation is None or observation.upper() == 'EXCLUDED TERM':
-                 observation = ''
-             else:
-                 observation_upper = observation.upper()
-                 if observation_upper in normD:
-                     observation = normD[observation_upper]
-             organ = ''
-
-             if relevance is None:
-                 relevance = 'NA'
-             tmp_table.append([study_id, relevance, observation, organ, dose])
-
-        cmd = "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
-            FINDING, DOSE \
-            FROM CLINICALHEMATOLOGIC"
-        cur.execute(cmd)
-        results = cur.fetchall()
-        for (study_id, relevance, observation, dose) in results:
-             if observation is None or observation.upper() == 'EXCLUDED TERM':
-                 observation = ''
-             else:
-                 observation_upper = observation.upper()
-                 if observation_upper in normD:
-                     observation = normD[observation_upper]
-             organ = ''
-
-             if relevance is None:
-                 relevance = 'NA'
-             tmp_table.append([study_id, relevance, observation, organ, dose])
-
-        cmd = "SELECT DISTINCT PARENT_LUID AS study_id, RELEVANCE, \
-            FINDING, STANDARDISED_ORGAN, DOSE \
-            FROM ORGAN_WEIGHTS"
-        cur.execute(cmd)
-        results = cur.fetchall()
-        for (study_id, relevance, observation, organ, dose) in results:
-             if observation is None or observation.upper() == 'EXCLUDED TERM':
-                 observation = ''
-             else:
-                 observation_upper = observation.upper()
-                 if observation_upper in normD:
-                     observation = normD[observation_upper]
-
-             if organ is None or organ.upper() == 'EXCLUDED TERM':
-                 organ = ''
-             else:
-                 organ_upper = organ.upper()
-                 if organ_upper in normD:
-                     organ = normD[organ_upper]
-
-             if relevance is None:
-                 relevance = 'NA'
-             tmp_table.append([study_id, relevance, observation, organ, dose])
-
-        find_df = pd.DataFrame(tmp_table, columns=['study_id', 'relevance',
-                        'observation_normalised', 'organ_normalised', 'dose'])
+    if metrics is None:
+        metrics = Metrics()
+    if indexes is None:
+        indexes = index_tables(study_df, find_df)
 
-        con.close()
+    sys.stderr.write('Filtering to relevant information\n')
+    with metrics.stage('filter', len(find_df)) as record:
+        strata_df = study_strata(args, study_df, indexes['study'])
+        index = indexes['findings']
+        rows = index['study_id'].lookup(strata_df.study_id.unique())
+        if args.treatment_related:
+            rows = intersect(rows, index['relevance'].lookup(['treatment related']))
+        relevant_find = relevant_findings(args, study_df, find_df, rows)
+        record['rows_out'] = len(relevant_find)
 
-    if args.treatment_related:
-        find_df = find_df[find_df.relevance == 'treatment related']
+    with metrics.stage('stats', len(relevant_find)) as record:
+        tagged_find = pd.merge(relevant_find, strata_df, how='inner', on='study_id',
+                                left_index=False, right_index=False, sort=False)
+        stats_df = substance_stats(tagged_find, ['stratum', 'subst_id'])
+        record['rows_out'] = len(stats_df)
 
-    return study_df,find_df
+    sys.stderr.write('Expand based on anatomic and morphological change ontologies\n')
+    with metrics.stage('expand', len(relevant_find)) as record:
+        expand_find = relevant_findings(args, study_df, find_df, 
+                                        expansion_rows(args, rows, indexes['findings']))
+        filtered_find = expand(expand_find,args)
+        record['rows_out'] = len(filtered_find)
+
+    if filtered_find.empty:
+        raise EmptyExtraction('Filtered out all rows, so the dataframe is empty.')
+
+    with metrics.stage('group', len(filtered_find)) as record:
+        filtered_find = pd.merge(filtered_find, strata_df, how='inner', on='study_id',
+                                left_index=False, right_index=False, sort=False)
+        group_df = min_doses(filtered_find, ['stratum', 'subst_id'])
+        record['rows_out'] = len(group_df)
+
+    return stats_df, group_df
+
+def save_grid(args, stats_df, group_df):
 
-def filter_study(args,study_df):
     """
+    Save the grid results in long format, as save_long() does, with the 
+    stratum of each row as first column
     """
-    df = study_df[:]
 
-    # Exposure
-    if args.min_exposure is not None and args.max_exposure is not None:
-        # An exposure range filter is defined
-        df = df[df.exposure_period_days >= args.min_exposure &
-                df.exposure_period_days <= args.max_exposure]
-    elif args.min_exposure is not None:
-        # Only a.upper bound for exposure range has been set
-        df = df[df.exposure_period_days >= args.min_exposure]
-    elif args.max_exposure is not None:
-        df = df[df.exposure_period_days <= args.max_exposure]
+    group_df = reported_findings(stats_df, group_df, ['stratum', 'subst_id'])
+    active = pd.MultiIndex.from_arrays([group_df.stratum, group_df.subst_id])
+    is_active = pd.MultiIndex.from_arrays([stats_df.stratum, stats_df.subst_id]).isin(active)
+    stats_df = stats_df.copy()
+    stats_df['is_active'] = np.where(is_active, 'True', 'False')
+    save_tables(args, [('_stats', stats_df.sort_values(['stratum', 'subst_id'])), 
+                    ('_findings', group_df.sort_values(['stratum', 'subst_id', 'finding']))])
 
-    # Administration route
-    if args.route:
-        df = df[df.normalised_administration_route.str.lower().isin([x.lower() for x in args.route])]
-        
-    # Species
-    if args.species:
-        df = df[df.normalised_species.str.lower().isin([x.lower() for x in args.species])]
-        
-    # Study's level sex
-    if args.sex:
-        df = df[df.normalised_sex.str.lower() == args.sex.lower()]
-    
-    return df
+def run_grid(args):
 
-def expand(df,args):
+    """
+    Run the extraction for every stratum of the grid on a single load,
+    filter and expansion of the data
+    """
+
+    metrics = Metrics(args.profile, args.profile_output)
+
+    sys.stderr.write('\nLoading background information for version %s\n' %args.version)
+    with metrics.stage('load') as record:
+        study_df, find_df, indexes = load_version(args)
+        record['rows_out'] = len(find_df)
 
+    stats_df, group_df = aggregate_grid(args, study_df, find_df, metrics, indexes)
+    with metrics.stage('write', len(group_df)):
+        save_grid(args, stats_df, group_df)
+
+    if args.metrics:
+        metrics.save(args.metrics, args)
+
+#################
+# Batch queries #
+#################
+# Arguments that can be set by each query spec of a batch
+spec_arguments = ['organ', 'observation', 'min_exposure', 'max_exposure', 
+                'route', 'species', 'sex', 'treatment_related', 
+                'output_basename', 'output_layout', 'output_format']
+# Dataframes shared by all the queries of a batch and their inverted 
+# indexes, along with the result cache and the fingerprint of the data
+batch_data = {}
+
+def init_batch(study_df, find_df, indexes, cache=None, fingerprint=None):
     """
-    Expand standardized observation and normalized organs based on
-    the hierarchy of ontologies stored in onto_df
+    Store the dataframes shared by all the queries of a batch
     """
-    # Create an empty output dataframe
-       
-    #########
-    # ORGAN #
-    #########
-    organs_dict={}
-    all_organs=set()
-    for organ in args.organ:    
-        all_related_organs = set([organ])
-        related_organs = onto_df[(onto_df.parent_term == organ) & 
-                            (onto_df.ontology == 'anatomy')]
-        all_related_organs = all_related_organs.union(related_organs.child_term)
-    
-        while not related_organs.empty:
-            related_organs = onto_df[(onto_df.parent_term.isin(related_organs.child_term)) & 
-                                (onto_df.ontology=='anatomy')]
-            all_related_organs = all_related_organs.union(related_organs.child_term)
-    
-        organs_dict.update({n: organ for n in all_related_organs})
-        all_organs = all_organs.union(all_related_organs,all_organs)
-    
-    df = df[df['organ_normalised'].isin(all_organs)]
-    df.loc[:,'organ_normalised'] = df['organ_normalised'].map(organs_dict)
+    batch_data['study_df'] = study_df
+    batch_data['find_df'] = find_df
+    batch_data['indexes'] = indexes
+    batch_data['cache'] = cache
+    batch_data['fingerprint'] = fingerprint
 
-   
-    ###############
-    # OBSERVATION #
-    ###############
-    if args.observation is None:
+def check_spec_values(arg, values):
+    """
+    Convert and check the values of a query spec argument as the command
+    line parser does, with its type and choices. None is kept as is.
+    """
+    if values is None:
+        return None
+    action = [action for action in build_parser()._actions if action.dest == arg][0]
+    if not isinstance(values, list):
+        raise argparse.ArgumentTypeError('Invalid %s in query spec: %r.' %(arg, values))
+    checked = []
+    for value in values:
+        if action.const is True:
+            # Flags only take booleans
+            valid = isinstance(value, bool)
+        else:
+            try:
+                value = action.type(value) if action.type else str(value)
+                valid = action.choices is None or value in action.choices
+            except (TypeError, ValueError, AttributeError):
+                valid = False
+        if not valid:
+            raise argparse.ArgumentTypeError('Invalid %s in query spec: %r.' %(arg, value))
+        checked.append(value)
+    return checked
 
-        obs_list=[]
-       
-        for row in df.to_dict('records'):
-           
-            obs_list.append(row)
-
-            parents=onto_df[(onto_df['child_term'] == row['observation_normalised']) & 
-                        (onto_df['ontology'] == 'histopathology')  & (onto_df['parent_term']!="morphologic change")]
-
-            while not parents.empty:
-                new_parents = []
-                #Add new row to the dataframe with the name of the parent 
-                for parent in parents.parent_term:
-                    new_row=row.copy()
-                    new_row['observation_normalised'] = parent
-                    obs_list.append(new_row)
-                    new_parents.append(parent)
-
-                parents = onto_df[(onto_df['child_term'].isin(new_parents))
-                            & (onto_df['ontology'] == 'histopathology') 
-                            & (onto_df['parent_term']!="morphologic change")]
-       
-        findings_out = df.from_dict(obs_list)
-        findings_out.drop_duplicates(inplace=True)
-        
+def spec_args(args, spec, index):
+    """
+    Build the arguments of a batch query from the command line arguments
+    and the query spec, with the same defaults and case handling as main()
+    """
+    unknown = set(spec).difference(spec_arguments)
+    if unknown:
+        raise argparse.ArgumentTypeError('Unknown arguments in query spec: %s.' 
+                                        %', '.join(sorted(unknown)))
+    query_args = argparse.Namespace(**vars(args))
+    for arg in ['organ', 'observation', 'route', 'species']:
+        values = spec.get(arg, getattr(args, arg))
+        if isinstance(values, str):
+            values = [values]
+        if arg in spec:
+            values = check_spec_values(arg, values)
+        elif values is not None:
+            values = [value.lower() for value in values]
+        setattr(query_args, arg, values)
+    for arg in ['min_exposure', 'max_exposure', 'sex', 'treatment_related', 
+                'output_layout', 'output_format']:
+        value = spec.get(arg, getattr(args, arg))
+        if arg in spec and value is not None:
+            value = check_spec_values(arg, [value])[0]
+        setattr(query_args, arg, value)
+    check_output_format(query_args.output_format)
+    query_args.output_basename = spec.get('output_basename', 
+                                '%s_%d' %(args.output_basename, index))
+    if not query_args.organ:
+        raise argparse.ArgumentTypeError('At least one organ is required in '
+                                        'query spec %d.' %index)
+    resolve_terms(query_args)
+    return query_args
+
+def run_spec(query_args):
+    """
+    Run a single batch query on the shared dataframes. Return whether it
+    succeeded and the metrics of its stages, tagged with the query's 
+    output base name. A profiled stage is stored in a file named after 
+    the output base name and the profile output.
+    """
+    profile_fname = '%s_%s' %(query_args.output_basename, 
+                            os.path.basename(query_args.profile_output))
+    metrics = Metrics(query_args.profile, profile_fname)
+    try:
+        run_query(query_args, batch_data['study_df'], batch_data['find_df'], 
+                metrics, batch_data['indexes'])
+        if batch_data['cache']:
+            batch_data['cache'].store(query_args, batch_data['fingerprint'])
+        succeeded = True
+    except Exception as e:
+        sys.stderr.write('Query %s failed: %s\n' %(query_args.output_basename, e))
+        succeeded = False
+    for record in metrics.stages:
+        record['query'] = query_args.output_basename
+    return succeeded, metrics.stages
+
+def run_batch(args):
+
+    """
+    Run all the queries in the batch file on the data loaded once. The
+    batch file is a JSON list of query specs, each one a dictionary with 
+    any of the arguments in spec_arguments. Arguments not set by a spec 
+    are taken from the command line.
+    """
+
+    metrics = Metrics(args.profile, args.profile_output)
+    with open(args.batch) as f:
+        specs = json.load(f)
+    queries = []
+    for i, spec in enumerate(specs):
+        queries.append(spec_args(args, spec, i))
+    n_queries = len(queries)
+
+    # Copy the results of the cached queries, loading the data only if 
+    # any query is left to run
+    cache = open_cache(args)
+    if cache and not args.bypass_cache and not snapshot_changes(args):
+        with metrics.stage('cache', n_queries) as record:
+            fingerprint = data_fingerprint(args)
+            queries = [query_args for query_args in queries 
+                        if not cache.fetch(query_args, fingerprint)]
+            record['rows_out'] = len(queries)
+        sys.stderr.write('%d queries found in the cache\n' %(n_queries-len(queries)))
+        if not queries:
+            if args.metrics:
+                metrics.save(args.metrics, args)
+            return
+
+    sys.stderr.write('\nLoading background information for version %s\n' %args.version)
+    with metrics.stage('load') as record:
+        study_df, find_df, indexes = load_version(args, pushdown=False)
+        record['rows_out'] = len(find_df)
+    fingerprint = data_fingerprint(args) if cache else None
+
+    sys.stderr.write('Running %d queries\n' %len(queries))
+    if args.batch_jobs > 1:
+        # The processes of the batch pool cannot start their own pools
+        for query_args in queries:
+            query_args.jobs = 1
+        pool = multiprocessing.Pool(args.batch_jobs, initializer=init_batch,
+                                    initargs=(study_df, find_df, indexes, cache, 
+                                            fingerprint))
+        status = pool.map(run_spec, queries, chunksize=1)
+        pool.close()
+        pool.join()
     else:
-        observation_dict = {}
-        all_observations = set()
-        for observation in args.observation:
-    
-            all_related_observation = set([observation])
-            related_observation = onto_df[(onto_df.parent_term == observation) 
-                                        & (onto_df.ontology == 'histopathology')]
-            all_related_observation = all_related_observation.union(related_observation.child_term)
-    
-            while not related_observation.empty:
-            
-                related_observation = onto_df[(onto_df.parent_term.isin(related_observation.child_term)) 
-                                    & (onto_df.ontology=='histopathology')]
-                all_related_observation = all_related_observation.union(related_observation.child_term)
-    
-            observation_dict.update({n: organ for n in all_related_observation})
-            all_observations = all_organs.union(all_related_observation,all_observation)
-    
-        findings_out=df[df['observation_normalised'].isin(all_organs)]
-        findings_out.loc[:,'observation_normalised']=df['observation_normalised'].map(organs_dict)
+        init_batch(study_df, find_df, indexes, cache, fingerprint)
+        status = [run_spec(query_args) for query_args in queries]
 
-    
-    return findings_out
+    for succeeded, stages in status:
+        metrics.stages.extend(stages)
+    if args.metrics:
+        metrics.save(args.metrics, args)
+    failed = [succeeded for succeeded, stages in status].count(False)
+    if failed:
+        raise Exception('%d out of %d queries failed.' %(failed, n_queries))
 
-def get_stats(group):
-    return {'min': group.min(), 'max': group.max()}
+###############
+# Server mode #
+###############
+class ExtractionServer(ThreadingMixIn, HTTPServer):
 
-def run(args):
+    """
+    HTTP server holding the loaded study and findings dataframes and their
+    inverted indexes. Each request is handled by its own thread, and its
+    extraction is run on a pool of jobs workers.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, args, study_df, find_df, indexes, jobs):
+        HTTPServer.__init__(self, address, ExtractionHandler)
+        self.args = args
+        self.study_df = study_df
+        self.find_df = find_df
+        self.indexes = indexes
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.executor.shutdown()
+
+class ExtractionHandler(BaseHTTPRequestHandler):
 
     """
-    Run the data extraction based on the parsed filters and expanding
-    based on the organs and morphological changes ontologies.
+    Handle the requests to the extraction server:
+    - GET /status: version and number of studies and findings loaded.
+    - POST /extract: run the extraction of the query spec in the JSON 
+      body, with the same arguments as a batch query spec, and stream
+      back the quantitative and qualitative tables as a JSON object, each
+      table in pandas' split orientation (columns, index and data).
+    """
+
+    def send_json(self, code, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.send_json(404, {'error': 'Unknown path %s.' %self.path})
+            return
+        self.send_json(200, {'version': self.server.args.version,
+                            'studies': len(self.server.study_df),
+                            'findings': len(self.server.find_df)})
+
+    def do_POST(self):
+        if self.path != '/extract':
+            self.send_json(404, {'error': 'Unknown path %s.' %self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            spec = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            if not isinstance(spec, dict):
+                raise argparse.ArgumentTypeError('The query spec must be a '
+                                                'JSON object.')
+            query_args = spec_args(self.server.args, spec, 0)
+            job = self.server.executor.submit(extract_results, query_args, 
+                                            self.server.study_df, 
+                                            self.server.find_df, None,
+                                            self.server.indexes)
+            quantitative_df, qualitative_df = job.result()
+        except (ValueError, argparse.ArgumentTypeError, EmptyExtraction) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        # Write each table as soon as it is serialised, closing the 
+        # connection to end the response
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(b'{"quantitative": ')
+        self.wfile.write(quantitative_df.to_json(orient='split').encode('utf-8'))
+        self.wfile.write(b', "qualitative": ')
+        self.wfile.write(qualitative_df.to_json(orient='split').encode('utf-8'))
+        self.wfile.write(b'}')
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s %s\n' %(time.strftime('%Y-%m-%d %H:%M:%S'), 
+                                    format %args))
+
+def serve(args):
+
     """
+    Load the data once and answer extraction requests over HTTP until 
+    interrupted
+    """
+
+    if args.metrics or args.profile:
+        raise argparse.ArgumentTypeError('--metrics and --profile are not '
+                                        'supported in server mode.')
 
     sys.stderr.write('\nLoading background information for version %s\n' %args.version)
-    study_df, find_df = load_version(args)
-    
-    #################################
-    # Select only relevant findings #
-    #################################
-    sys.stderr.write('Filtering to relevant information\n')
-    relevant_studies_df = filter_study(args,study_df)
-    relevant_find = find_df[find_df.study_id.isin(relevant_studies_df.study_id)]
-    relevant_find = pd.merge(relevant_find, study_df[['study_id', 'subst_id']],
-                        how='left', on='study_id', left_index=False,
-                        right_index=False, sort=False)
-    
-    ###################################
-    # Get stats for relevant findings #
-    ###################################
-    # Get the number of studies per substance
-    count_df = relevant_find.groupby(('subst_id')).study_id.nunique().to_frame().reset_index()
-    # Get the global dose range per substance
-    range_df = relevant_find[relevant_find.dose > 0]
-    range_df = range_df.groupby(('subst_id')).dose.apply(get_stats).unstack().reset_index()
-    # Get all stats into a single dataframe
-    stats_df = pd.merge(count_df, range_df, how='inner', on='subst_id', 
-                        left_index=False, right_index=False, sort=False)
-    stats_df.columns = ['subst_id', 'study_count', 'dose_max', 'dose_min']
+    study_df, find_df, indexes = load_version(args, pushdown=False)
+    # Load the ontology before serving, so that requests do not race to 
+    # load it
+    load_ontology(args)
 
-    ###################################################################
-    # Expand based on anatomical and morphological changes ontologies #
-    ###################################################################
-    # Expand organs and histopathological findings according to the ontologies 
-    # and filter by finding-based arguments
-    sys.stderr.write('Expand based on anatomic and morphological change ontologies\n')
-    filtered_find = expand(relevant_find,args)
+    server = ExtractionServer((args.server_host, args.serve), args, study_df, 
+                            find_df, indexes, args.server_jobs)
+    sys.stderr.write('Serving on http://%s:%d\n' %(args.server_host, args.serve))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-    if filtered_find.empty:
-        raise Exception('Filtered out all rows, so the dataframe is empty.')
+def resolve_terms(args):
 
-    ######################################
-    # Aggragate by substance and finding #
-    ######################################
-    # Define finding as organ+observation
-    filtered_find.organ_normalised = filtered_find.organ_normalised.fillna('NA')
-    filtered_find.observation_normalised = filtered_find.observation_normalised.fillna('NA')
-    filtered_find['finding'] = filtered_find.apply(lambda row: row.organ_normalised+'_'+row.observation_normalised, axis=1)
-    filtered_find = filtered_find[['subst_id', 'finding', 'dose']]
+    """
+    Replace the lowercase organs and observations in args by the terms
+    in the ontology that match them
+    """
+    onto_df = load_ontology(args)[0]
 
-    # Aggregate by substance and finding (as defined above), keeping the minimum dose 
-    # for each substance/finding instance
-    group_df = filtered_find.groupby(('subst_id', 'finding')).min().add_prefix('min_').reset_index()
-    
-    #######################################
-    # Pivot so that each finding is a row #
-    #######################################
-    ### Quantitative
-    pivotted_df = group_df.pivot_table(index='subst_id', columns='finding', values='min_dose').reset_index()
-    pivotted_df['is_active'] = 'True'
-    quantitative_df = pd.merge(stats_df, pivotted_df, how='left', on='subst_id', 
-                                left_index=False, right_index=False, sort=False)
-    quantitative_df.is_active = quantitative_df.is_active.fillna('False')
-    # Reorder columns
-    cols = quantitative_df.columns.tolist()
-    cols = cols[0:4]+[cols[-1]]+cols[4:-1]
-    quantitative_df = quantitative_df[cols]
-    
-    ### Qualitative
-    group_df.loc[:,'min_dose'] = 1
-    pivotted_df = group_df.pivot_table(index='subst_id', columns='finding', values='min_dose').reset_index()
-    pivotted_df['is_active'] = 'True'
-    qualitative_df = pd.merge(stats_df, pivotted_df, how='left', on='subst_id',
-                                left_index=False, right_index=False, sort=False)
-    qualitative_df.is_active = qualitative_df.is_active.fillna('False')
-    # Reorder columns
-    cols = qualitative_df.columns.tolist()
-    cols = cols[0:4]+[cols[-1]]+cols[4:-1]
-    qualitative_df = qualitative_df[cols]
+    if args.observation:
+        right_case_observations = []
+        for obs in args.observation:
+            right_case_obs =  list(onto_df[onto_df['parent_term'].str.lower() == obs].parent_term.unique())
+            if len(right_case_obs) == 0:
+                sys.stderr.write('The observation %s is not found in the database.\n' %obs)
+            else:
+                right_case_observations.extend(right_case_obs)
+        if len(right_case_observations) == 0:
+            raise argparse.ArgumentTypeError('None of the observations you are trying \
+                                            to filter for are found: %s.' %args.observation)
+        args.observation = right_case_observations
+
+    right_case_organs = []
+    for org in args.organ:
+        right_case_obs =  list(onto_df[onto_df['parent_term'].str.lower() == org].parent_term.unique())
+        if len(right_case_obs) == 0:
+            sys.stderr.write('The organ %s is not found in the database.\n' %org)
+        else:
+            right_case_organs.extend(right_case_obs)
+    if len(right_case_organs) == 0:
+        raise argparse.ArgumentTypeError('None of the organs you are trying to filter \
+                                        for are found: %s.' %args.organ)
+    args.organ = right_case_organs
 
-    ####################
-    # Save the results #
-    ####################
-    quantitative_df.to_csv(args.output_basename+'_quant.tsv', 
-                            sep='\t', index=False)
-    qualitative_df.to_csv(args.output_basename+'_qual.tsv', 
-                            sep='\t', index=False)
+#################
+# Extractor API #
+#################
+class Extractor(object):
 
-def main ():
     """
-    Parse arguments and load the extraction filters.
+    Hold the study, findings and ontology data of a Vitic database version
+    and run extractions on them in memory. Each table is loaded the first
+    time it is needed and kept for the following extractions, from the 
+    data directory of the extractor if given. The study and findings 
+    dataframes are indexed once loaded, so they must not be modified in 
+    place.
+
+    >>> extractor = Extractor('2016.1')
+    >>> quantitative_df, qualitative_df = extractor.extract(organ=['liver'], 
+    ...                                                     species=['rat'])
+    """
+
+    def __init__(self, version='2016.2', sid=None, user=None, passw=None, 
+                arraysize=5000, concurrent_queries=False, sqlite=None,
+                snapshot=None, refresh_snapshot=False, refresh_delta=False, 
+                data_dir=None, store=None):
+        self.args = argparse.Namespace(version=version, sid=sid, user=user, 
+                    passw=passw, arraysize=arraysize, 
+                    concurrent_queries=concurrent_queries, sqlite=sqlite, 
+                    snapshot=snapshot, refresh_snapshot=refresh_snapshot,
+                    refresh_delta=refresh_delta, data_dir=data_dir, store=store, 
+                    organ=None, 
+                    observation=None, min_exposure=None, max_exposure=None, 
+                    route=None, species=None, sex=None, 
+                    treatment_related=False, output_basename='output',
+                    output_layout='dense', output_format='tsv', jobs=1)
+        self._study_df = None
+        self._find_df = None
+        self._indexes = None
+
+    def load(self):
+        """
+        Load the study and findings dataframes and their inverted indexes, 
+        unless already loaded
+        """
+        if self._study_df is None:
+            self._study_df, self._find_df, self._indexes = load_version(self.args, 
+                                                                    pushdown=False)
+
+    @property
+    def onto_df(self):
+        return load_ontology(self.args)[0]
+
+    @property
+    def study_df(self):
+        self.load()
+        return self._study_df
+
+    @property
+    def find_df(self):
+        self.load()
+        return self._find_df
+
+    def extract(self, **filters):
+        """
+        Run an extraction and return the quantitative and qualitative 
+        dataframes. The filters are the query spec arguments of a batch 
+        (organ, observation, min_exposure, max_exposure, route, species, 
+        sex and treatment_related).
+        """
+        query_args = spec_args(self.args, filters, 0)
+        return extract_results(query_args, self.study_df, self.find_df, None, 
+                            self._indexes)
+
+def build_parser():
+    """
+    Build the parser of the command line arguments
     """
     parser = argparse.ArgumentParser(description='Exract studies\' \
             findings based on the given filtering and the organs\' and \
@@ -426,12 +2369,47 @@ def main ():
     parser.add_argument('-p', '--passw', help='If working with Vitic \
             database version 2016.2, provide the Oracle database \
             password.',  required=False)
+    parser.add_argument('--arraysize', help='If working with Vitic database \
+            version 2016.2, number of rows fetched from the Oracle database \
+            at a time (default: 5000).', type=int, default=5000, required=False)
+    parser.add_argument('--concurrent_queries', help='If working with Vitic \
+            database version 2016.2, run the study and findings queries at \
+            the same time on a pool of Oracle sessions.', action='store_true',
+            default= False, required=False)
+    parser.add_argument('--sqlite', help='If working with Vitic database \
+            version 2016.2, SQLite database with the same tables to query \
+            instead of the Oracle database, such as the one generated by \
+            synthetic.py.', required=False)
+    parser.add_argument('--snapshot', help='If working with Vitic database \
+            version 2016.2, HDF5 file where the normalised extraction is \
+            stored. If it already exists, it is loaded instead of querying \
+            the Oracle database.', required=False)
+    parser.add_argument('--refresh_snapshot', help='Query the Oracle database \
+            and overwrite the snapshot even if it already exists.', 
+            action='store_true', default= False, required=False)
+    parser.add_argument('--refresh_delta', help='Fetch only the rows added \
+            to each table since the snapshot was stored, according to their \
+            LUID, and merge them into the snapshot. Updated or deleted rows \
+            require --refresh_snapshot.', action='store_true', default= False, 
+            required=False)
+
+    parser.add_argument('--prepare', help='Load the data of the version \
+            from the data files, the Oracle database or the snapshot, and \
+            store it in this directory as a memory-mapped store, to be \
+            opened with --store.', required=False)
+    parser.add_argument('--store', help='Memory-mapped store generated with \
+            --prepare to load the data from. Processes opening the same \
+            store share its memory.', required=False)
+
+    parser.add_argument('--data_dir', help='Directory with the ontology, \
+            the normalisation lookup table and the 2016.1 data files \
+            (default: the data directory of the package).', required=False)
 
     # Study-related arguments
     parser.add_argument('-i', '--min_exposure', help='Minimum exposure \
-            period (days).', required=False)
+            period (days).', type=int, required=False)
     parser.add_argument('-e', '--max_exposure', help='Maximum exposure \
-            period (days).', required=False)
+            period (days).', type=int, required=False)
     parser.add_argument('-r', '--route', help='Administration route. You can filter for \
             more than one administration route by passing a blank space-separated list.', 
             choices=['cutaneous', 'diertary', 'oral', 'oral gavage', 
@@ -459,8 +2437,9 @@ def main ():
     # Finding-related arguments
     parser.add_argument('-a', '--organ', help='Anatomical entity that the \
             finding refers to. You can filter for more than one organ by passing \
-            a blank space-separated list.', type= str.lower,
-            nargs='*', required=True)
+            a blank space-separated list. Required unless running a batch \
+            or a server.', 
+            type= str.lower, nargs='*', required=False)
     parser.add_argument('-m', '--observation', help='Morphological change \
             type that the finding refers to. You can filter for more than one \
             morphological change by passing a blank space-separated list.', type= str.lower,
@@ -469,41 +2448,123 @@ def main ():
             findings.', action='store_true', default= False,
             required=False)
     
+    # Execution-related arguments
+    parser.add_argument('-j', '--jobs', help='Number of processes the \
+            relevant findings are aggregated on, each one handling a \
+            partition of the substances (default: 1).', type=int, default=1,
+            required=False)
+
     # Output file base name
     parser.add_argument('-o', '--output_basename', help='Output file base name. Two output \
             files will be generated: basename_quant.tsv and basename_qual.tsv, with \
             quantitative and qualitative results respectively. (default: output).', 
             default= 'output', required=False)
+    parser.add_argument('--output_layout', help='Layout of the results \
+            (default: dense). dense: basename_quant.tsv and basename_qual.tsv \
+            substance x finding tables. long: basename_stats.tsv with the stats \
+            per substance and basename_findings.tsv with a row per reported \
+            substance/finding and its minimum dose. sparse: basename_stats.tsv, \
+            basename_findings.txt and basename_quant.mtx, a MatrixMarket \
+            substance x finding matrix of minimum doses.', 
+            choices=['dense', 'long', 'sparse'], default='dense', required=False)
+    parser.add_argument('--output_format', help='Format of the dense and long \
+            layouts\' results files, each one written at the same time \
+            (default: tsv). tsv and tsv.gz: tab-separated values, plain or \
+            gzip-compressed. parquet and feather: Apache Arrow columnar \
+            files, which require pyarrow. hdf5: HDF5 file with the table \
+            stored under the results key.', 
+            choices=['tsv', 'tsv.gz', 'parquet', 'feather', 'hdf5'], 
+            default='tsv', required=False)
+
+    # Grid-related arguments
+    parser.add_argument('--exposure_bins', help='Exposure bins of the grid, \
+            as MIN-MAX, MIN- or -MAX days. You can pass more than one bin as \
+            a blank space-separated list. The results of every bin are \
+            computed at once.', type=exposure_bin, nargs='+', required=False)
+    parser.add_argument('--strata', help='Study design columns the grid is \
+            stratified by, each of their values being a stratum.', 
+            choices=['species', 'route'], nargs='+', required=False)
+
+    # Cache-related arguments
+    parser.add_argument('--result_cache', help='Directory where the output \
+            files of each extraction are cached, keyed by its filters and a \
+            fingerprint of the data and the ontology. Cached results are \
+            copied instead of running the extraction again.', required=False)
+    parser.add_argument('--cache_size', help='Size limit of the result cache \
+            in MB, above which the least recently used results are evicted \
+            (default: 500).', type=float, default=500, required=False)
+    parser.add_argument('--bypass_cache', help='Run the extraction even if \
+            its results are cached, and replace them in the cache.', 
+            action='store_true', default= False, required=False)
+
+    # Metrics-related arguments
+    parser.add_argument('--metrics', help='JSON file where the wall time, CPU \
+            time, peak memory so far and input/output row counts of each \
+            stage of the run, or of each query of a batch, are reported. Not \
+            supported in server mode.', required=False)
+    parser.add_argument('--profile', help='Stage of the run to profile with \
+            cProfile. aggregate replaces stats, expand and group when \
+            running on several jobs.', choices=['cache', 'load', 'filter', 
+            'stats', 'expand', 'group', 'aggregate', 'pivot', 'write'], 
+            required=False)
+    parser.add_argument('--profile_output', help='File where the cProfile \
+            stats of the profiled stage are stored (default: profile.prof).', 
+            default='profile.prof', required=False)
+
+    # Batch-related arguments
+    parser.add_argument('--batch', help='JSON file with a list of query specs \
+            to run on the data loaded once. Each spec is a dictionary with any \
+            of the arguments organ, observation, min_exposure, max_exposure, \
+            route, species, sex, treatment_related, output_basename, \
+            output_layout and output_format. Missing arguments are taken from the command \
+            line.', required=False)
+    parser.add_argument('--batch_jobs', help='Number of batch queries run in \
+            parallel (default: 1).', type=int, default=1, required=False)
+
+    # Server-related arguments
+    parser.add_argument('--serve', help='Load the data once and answer \
+            extraction requests on this HTTP port. POST /extract takes a \
+            JSON query spec, as in a batch, and returns the quantitative \
+            and qualitative tables.', type=int, required=False)
+    parser.add_argument('--server_host', help='Address the server listens \
+            on (default: 127.0.0.1).', default='127.0.0.1', required=False)
+    parser.add_argument('--server_jobs', help='Number of extractions the \
+            server runs at the same time (default: 4).', type=int, default=4,
+            required=False)
+
+    return parser
 
-    args = parser.parse_args()
-    if args.version == '2016.2' and args.passw is None:
+def main ():
+    """
+    Parse arguments and load the extraction filters.
+    """
+    args = build_parser().parse_args()
+    check_output_format(args.output_format)
+    if args.version == '2016.2' and args.passw is None and not args.sqlite \
+        and not args.store and (args.refresh_delta or not snapshot_is_valid(args)):
        raise argparse.ArgumentTypeError('Oracle database password required to work \
                                         with version 2016.2.')
 
-    if args.observation:
-        right_case_observations = []
-        for obs in args.observation:
-            right_case_obs =  list(onto_df[onto_df['parent_term'].str.lower() == obs].parent_term.unique())
-            if len(right_case_obs) == 0:
-                sys.stderr.write('The observation %s is not found in the database.\n' %obs)
-            else:
-                right_case_observations.extend(right_case_obs)
-        if len(right_case_observations) == 0:
-            raise argparse.ArgumentTypeError('None of the observations you are trying \
-                                            to filter for are found: %s.' %args.observation)
-        args.observation = right_case_observations
+    if args.prepare:
+        prepare(args)
+        return
 
-    right_case_organs = []
-    for org in args.organ:
-        right_case_obs =  list(onto_df[onto_df['parent_term'].str.lower() == org].parent_term.unique())
-        if len(right_case_obs) == 0:
-            sys.stderr.write('The organ %s is not found in the database.\n' %org)
-        else:
-            right_case_organs.extend(right_case_obs)
-    if len(right_case_organs) == 0:
-        raise argparse.ArgumentTypeError('None of the organs you are trying to filter \
-                                        for are found: %s.' %args.organ)
-    args.organ = right_case_organs
+    if args.serve:
+        serve(args)
+        return
+
+    if args.batch:
+        run_batch(args)
+        return
+
+    if not args.organ:
+        raise argparse.ArgumentTypeError('At least one organ is required '
+                                        'unless running a batch or a server.')
+    resolve_terms(args)
+
+    if args.exposure_bins or args.strata:
+        run_grid(args)
+        return
 
     run(args)
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#! -*- coding: utf-8 -*-
+
+##    Description    Synthetic Vitic data generator for RDTextractor
+##
+##    Authors:       Elisabet Gregori (elisabet.gregori@upf.edu)
+##                   Ignacio Pasamontes (ignacio.pasamontes@upf.edu)
+##
+##    Copyright 2018 Elisabet Gregori & Ignacio Pasamontes
+##
+##    RDTextractor is free software: you can redistribute it
+##    and/or modify it under the terms of the GNU General Public
+##    License as published by the Free Software Foundation version 3.
+##
+##    RDTextractor is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with this code. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse, os, sqlite3, sys
+import numpy as np
+import pandas as pd
+
+# Study design vocabularies, as found in the normalised Vitic tables
+sexes = ['F', 'M', 'Both']
+routes = ['Oral', 'Oral gavage', 'Dietary', 'Intravenous', 'Subcutaneous',
+        'Intraperitoneal', 'Respiratory (inhalation)', 'Cutaneous']
+species = ['Rat', 'Mouse', 'Dog', 'Monkey', 'Rabbit', 'Marmoset']
+exposures = [1, 7, 14, 28, 90, 182, 365]
+doses = [0, 1, 3, 10, 30, 100, 300, 1000]
+
+def make_tree(root, prefix, n_terms, rng, extra_parents=0):
+    """
+    Generate a random multi-level hierarchy of n_terms below the root,
+    each new term hanging from a randomly chosen existing term. Some terms
+    get a second parent, as in the histopathology ontology.
+    """
+    terms = [root]
+    edges = []
+    for i in range(n_terms):
+        term = '%s %d' %(prefix, i+1)
+        edges.append((terms[rng.randint(len(terms))], term))
+        terms.append(term)
+    for i in range(extra_parents):
+        child = rng.randint(2, len(terms))
+        parent = rng.randint(1, child)
+        if (terms[parent], terms[child]) not in edges:
+            edges.append((terms[parent], terms[child]))
+    return terms, edges
+
+def make_ontology(n_organs, n_observations, rng):
+    """
+    Generate the anatomy and histopathology ontologies, with the same
+    columns as ontology.pkl
+    """
+    organs, organ_edges = make_tree('body', 'organ', n_organs, rng)
+    observations, observation_edges = make_tree('morphologic change',
+                                        'observation', n_observations, rng,
+                                        extra_parents=n_observations//10)
+    onto_df = pd.DataFrame(organ_edges+observation_edges,
+                            columns=['parent_term', 'child_term'])
+    onto_df['ontology'] = ['anatomy']*len(organ_edges)+ \
+                            ['histopathology']*len(observation_edges)
+    return onto_df, organs[1:], observations[1:]
+
+def make_studies(n_studies, n_substances, rng):
+    """
+    Generate the normalised study dataframe, with the same columns as
+    study.pkl
+    """
+    return pd.DataFrame({'study_id': np.arange(1, n_studies+1),
+            'subst_id': rng.randint(1, n_substances+1, n_studies),
+            'normalised_sex': rng.choice(sexes, n_studies),
+            'normalised_administration_route': rng.choice(routes, n_studies),
+            'normalised_species': rng.choice(species, n_studies),
+            'exposure_period_days': rng.choice(exposures, n_studies)},
+            columns=['study_id', 'subst_id', 'normalised_sex',
+                    'normalised_administration_route', 'normalised_species',
+                    'exposure_period_days'])
+
+def make_findings(study_df, n_findings, organs, observations, rng):
+    """
+    Generate the normalised findings dataframe, with the same columns as
+    findings.pkl.gz, and the table each finding comes from. Organs and
+    observations follow a Zipf-like distribution, as in Vitic.
+    """
+    def skewed(terms, n):
+        weights = 1.0/np.arange(1, len(terms)+1)
+        return rng.choice(terms, n, p=weights/weights.sum())
+
+    clinical = ['clinical finding %d' %(i+1) for i in range(50)]
+    weights = ['increased weight', 'decreased weight']
+    table = rng.choice(['HISTOPATHOLOGICALFI', 'CLINICALCHEMICALFIN',
+                        'CLINICALHEMATOLOGIC', 'ORGAN_WEIGHTS'], n_findings,
+                        p=[0.7, 0.1, 0.1, 0.1])
+    find_df = pd.DataFrame({'study_id': rng.choice(study_df.study_id, n_findings),
+            'relevance': rng.choice(['treatment related', 'not treatment related',
+                                    'NA'], n_findings),
+            'observation_normalised': skewed(observations, n_findings),
+            'organ_normalised': skewed(organs, n_findings),
+            'dose': rng.choice(doses, n_findings).astype(float)},
+            columns=['study_id', 'relevance', 'observation_normalised',
+                    'organ_normalised', 'dose'])
+    is_clinical = np.isin(table, ['CLINICALCHEMICALFIN', 'CLINICALHEMATOLOGIC'])
+    find_df.loc[is_clinical, 'observation_normalised'] = rng.choice(clinical, is_clinical.sum())
+    find_df.loc[is_clinical, 'organ_normalised'] = ''
+    is_weight = table == 'ORGAN_WEIGHTS'
+    find_df.loc[is_weight, 'observation_normalised'] = rng.choice(weights, is_weight.sum())
+    find_df['table'] = table
+    return find_df
+
+def make_normalisation(terms):
+    """
+    Generate the normalisation lookup table, mapping two raw variants of
+    each normalised term (its upper case form and a synonym) to it
+    """
+    normD = {}
+    for term in terms:
+        normD[term.upper()] = term
+        normD[term.upper()+' (SYN)'] = term
+    return normD
+
+def raw_terms(values, rng, missing=0.01):
+    """
+    Turn normalised terms back into raw Vitic terms: synonyms and mixed
+    case variants, and a few excluded or missing terms
+    """
+    raw = values.astype(object).copy()
+    empty = raw == ''
+    synonym = rng.rand(len(raw)) < 0.3
+    raw[synonym] = raw[synonym]+' (syn)'
+    lower = rng.rand(len(raw)) < 0.5
+    raw[lower] = raw[lower].str.lower()
+    raw[rng.rand(len(raw)) < missing] = 'Excluded term'
+    raw[empty | (rng.rand(len(raw)) < missing)] = None
+    return raw
+
+def write_sqlite(fname, study_df, find_df, rng):
+    """
+    Write a SQLite stand-in of the Vitic Oracle database, with the tables
+    and columns queried by extract.py for version 2016.2 filled with raw
+    terms. Studies are queried by SUBST_ID in Vitic, so the findings of
+    each study refer to the SUBST_ID of its substance.
+    """
+    if os.path.isfile(fname):
+        os.remove(fname)
+    con = sqlite3.connect(fname)
+
+    substances = pd.DataFrame({'LUID': np.arange(1, study_df.subst_id.max()+1)})
+    substances['SUBST_ID'] = substances.LUID
+    substances.to_sql('SUBSTANCE_IDS', con, index=False)
+
+    pd.DataFrame({'LUID': study_df.study_id,
+                'STRUCTURE_LUID': study_df.subst_id,
+                'STANDARDISED_SEX': study_df.normalised_sex.str.upper(),
+                'STANDARDISED_ROUTE': raw_terms(study_df.normalised_administration_route,
+                                                rng, missing=0),
+                'STANDARDISED_SPECIES': raw_terms(study_df.normalised_species, rng),
+                'EXPOSURE_PERIOD': study_df.exposure_period_days}
+                ).to_sql('STUDY_DESIGN', con, index=False)
+
+    parents = study_df.set_index('study_id').subst_id
+    columns = {'HISTOPATHOLOGICALFI': ['STANDARDISED_PATHOLOGY', 'STANDARDISED_ORGAN'],
+                'CLINICALCHEMICALFIN': ['FINDING'],
+                'CLINICALHEMATOLOGIC': ['FINDING'],
+                'ORGAN_WEIGHTS': ['FINDING', 'STANDARDISED_ORGAN']}
+    for table in columns:
+        df = find_df[find_df.table == table]
+        out = pd.DataFrame({'LUID': np.arange(1, len(df)+1),
+                            'PARENT_LUID': parents.loc[df.study_id].values,
+                            'RELEVANCE': df.relevance.replace('NA', np.nan).values})
+        out[columns[table][0]] = raw_terms(df.observation_normalised, rng).values
+        if len(columns[table]) > 1:
+            out['STANDARDISED_ORGAN'] = raw_terms(df.organ_normalised, rng).values
+        out['DOSE'] = df.dose.values
+        out.to_sql(table, con, index=False)
+    con.commit()
+    con.close()
+
+def generate(out_dir, n_studies=1000, n_substances=200, n_findings=100000,
+            n_organs=200, n_observations=300, seed=0):
+    """
+    Generate a synthetic Vitic-shaped data set in out_dir: ontology.pkl,
+    normalisation.pkl, the 2016.1 study.pkl and findings.pkl.gz files, and
+    vitic.sqlite, a SQLite stand-in of the 2016.2 Oracle database.
+    """
+    rng = np.random.RandomState(seed)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    onto_df, organs, observations = make_ontology(n_organs, n_observations, rng)
+    study_df = make_studies(n_studies, n_substances, rng)
+    find_df = make_findings(study_df, n_findings, organs, observations, rng)
+    normD = make_normalisation(organs+observations+sexes+routes+species+
+                            list(find_df.observation_normalised.unique()))
+
+    onto_df.to_pickle(os.path.join(out_dir, 'ontology.pkl'))
+    pd.to_pickle(normD, os.path.join(out_dir, 'normalisation.pkl'))
+    study_df.to_pickle(os.path.join(out_dir, 'study.pkl'))
+    find_df.drop('table', axis=1).to_pickle(os.path.join(out_dir, 'findings.pkl.gz'),
+                                            compression='gzip')
+    write_sqlite(os.path.join(out_dir, 'vitic.sqlite'), study_df, find_df, rng)
+
+def main ():
+    """
+    Parse arguments and generate the synthetic data set.
+    """
+    parser = argparse.ArgumentParser(description='Generate a synthetic \
+            Vitic-shaped data set: ontology, normalisation lookup table, \
+            2016.1 data files and a SQLite stand-in of the 2016.2 Oracle \
+            database. Use it with extract.py --data_dir and --sqlite.')
+    parser.add_argument('-o', '--out_dir', help='Output directory.', required=True)
+    parser.add_argument('--studies', help='Number of studies (default: 1000).',
+            type=int, default=1000, required=False)
+    parser.add_argument('--substances', help='Number of substances (default: 200).',
+            type=int, default=200, required=False)
+    parser.add_argument('--findings', help='Number of findings (default: 100000).',
+            type=int, default=100000, required=False)
+    parser.add_argument('--organs', help='Number of anatomy terms (default: 200).',
+            type=int, default=200, required=False)
+    parser.add_argument('--observations', help='Number of histopathology terms \
+            (default: 300).', type=int, default=300, required=False)
+    parser.add_argument('--seed', help='Random seed (default: 0).',
+            type=int, default=0, required=False)
+    args = parser.parse_args()
+
+    generate(args.out_dir, args.studies, args.substances, args.findings,
+            args.organs, args.observations, args.seed)
+    sys.stderr.write('Synthetic data set written to %s\n' %args.out_dir)
+
+if __name__ == '__main__':
+    main()
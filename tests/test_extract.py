@@ -0,0 +1,123 @@
+#! -*- coding: utf-8 -*-
+
+##    Description    Regression tests of extract.py on synthetic data sets
+##
+##    Copyright 2018 Elisabet Gregori & Ignacio Pasamontes
+##
+##    RDTextractor is free software: you can redistribute it
+##    and/or modify it under the terms of the GNU General Public
+##    License as published by the Free Software Foundation version 3.
+##
+##    RDTextractor is distributed in the hope that it will be useful,
+##    but WITHOUT ANY WARRANTY; without even the implied warranty of
+##    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##    GNU General Public License for more details.
+##
+##    You should have received a copy of the GNU General Public License
+##    along with this code. If not, see <http://www.gnu.org/licenses/>.
+
+import os, sys
+import pandas as pd
+import pytest
+
+# The scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'extract'))
+import extract
+import synthetic
+
+# Queries compared in every test: a broad one over the whole anatomy and
+# a narrow one with study design and observation filters
+queries = {'broad': {'organ': ['body']},
+            'narrow': {'organ': ['organ 1', 'organ 2'], 'observation': ['observation 1'],
+                        'species': ['rat', 'dog'], 'min_exposure': 7,
+                        'treatment_related': True}}
+
+@pytest.fixture(scope='module')
+def data_dir(tmpdir_factory):
+    """
+    Synthetic data set shared by the tests
+    """
+    out_dir = str(tmpdir_factory.mktemp('synthetic'))
+    synthetic.generate(out_dir, n_studies=300, n_substances=60, n_findings=20000,
+                    n_organs=40, n_observations=60)
+    return out_dir
+
+def assert_same_results(results, other_results):
+    """
+    Check that two pairs of quantitative and qualitative tables are equal
+    """
+    for df, other_df in zip(results, other_results):
+        pd.testing.assert_frame_equal(df.reset_index(drop=True),
+                                    other_df.reset_index(drop=True),
+                                    check_dtype=False)
+
+def query_args(extractor, name):
+    """
+    Build the arguments of one of the queries
+    """
+    return extract.spec_args(extractor.args, queries[name], 0)
+
+@pytest.mark.parametrize('name', sorted(queries))
+@pytest.mark.parametrize('version', ['2016.1', '2016.2'])
+def test_pushdown_matches_full_load(data_dir, version, name):
+    extractor = extract.Extractor(version, sqlite=os.path.join(data_dir, 'vitic.sqlite'),
+                                data_dir=data_dir)
+    args = query_args(extractor, name)
+    pushed_down = extract.extract_results(args, *extract.load_version(args)[:2])
+    assert_same_results(pushed_down, extractor.extract(**queries[name]))
+
+@pytest.mark.parametrize('name', sorted(queries))
+def test_long_matches_dense(data_dir, tmpdir, name):
+    extractor = extract.Extractor('2016.1', data_dir=data_dir)
+    args = query_args(extractor, name)
+    quantitative_df, qualitative_df = extractor.extract(**queries[name])
+    args.output_layout = 'long'
+    args.output_basename = str(tmpdir.join('long'))
+    extract.run_query(args, extractor.study_df, extractor.find_df)
+    stats_df = pd.read_csv(args.output_basename+'_stats.tsv', sep='\t')
+    group_df = pd.read_csv(args.output_basename+'_findings.tsv', sep='\t')
+
+    stats_columns = list(stats_df.columns)
+    assert stats_columns == list(quantitative_df.columns[:len(stats_columns)])
+    dense_stats_df = quantitative_df[stats_columns]
+    dense_stats_df['is_active'] = dense_stats_df.is_active == 'True'
+    assert_same_results([stats_df], [dense_stats_df])
+    # Every substance/finding instance is reported in both layouts
+    assert set(group_df.subst_id) <= set(stats_df.subst_id)
+    findings = list(quantitative_df.columns[len(stats_columns):])
+    pivoted_df = group_df.pivot_table(index='subst_id', columns='finding',
+                                    values='min_dose')
+    pivoted_df = pivoted_df.reindex(index=quantitative_df.subst_id, columns=findings)
+    pivoted_df.columns.name = None
+    assert_same_results([pivoted_df], [quantitative_df.set_index('subst_id')[findings]])
+    assert_same_results([pivoted_df.notnull()],
+                        [qualitative_df.set_index('subst_id')[findings].notnull()])
+
+def test_extractors_keep_their_data_dir(data_dir, tmpdir):
+    other_dir = str(tmpdir.join('other'))
+    synthetic.generate(other_dir, n_studies=100, n_substances=20, n_findings=5000,
+                    n_organs=40, n_observations=60, seed=1)
+    expected = extract.Extractor('2016.1', data_dir=data_dir).extract(organ=['body'])
+    extractor = extract.Extractor('2016.1', data_dir=data_dir)
+    other_extractor = extract.Extractor('2016.1', data_dir=other_dir)
+    other_results = other_extractor.extract(organ=['body'])
+    assert_same_results(extractor.extract(organ=['body']), expected)
+    assert len(other_results[0]) != len(expected[0])
+
+@pytest.mark.parametrize('name', sorted(queries))
+def test_store_matches_data_files(data_dir, tmpdir, name):
+    extractor = extract.Extractor('2016.1', data_dir=data_dir)
+    store_dir = str(tmpdir.join('store'))
+    study_df, find_df, indexes = extract.load_version(extractor.args, pushdown=False)
+    extract.save_store(store_dir, study_df, find_df, indexes, extractor.args)
+    store_extractor = extract.Extractor('2016.1', data_dir=data_dir, store=store_dir)
+    assert_same_results(store_extractor.extract(**queries[name]),
+                        extractor.extract(**queries[name]))
+
+@pytest.mark.parametrize('name', sorted(queries))
+def test_jobs_match_single_process(data_dir, name):
+    extractor = extract.Extractor('2016.1', data_dir=data_dir)
+    results = extractor.extract(**queries[name])
+    extractor.args.jobs = 3
+    assert_same_results(extractor.extract(**queries[name]), results)